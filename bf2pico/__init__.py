@@ -2,6 +2,10 @@
         - an sdk for brewfather
         - a translator from brewfather to pico
         - a webapp that can run the pico using brewfather as the gui
+
+    Importing me makes no network calls. The ssm client, the bucket and
+    the website are looked up on first use with get_ssm, get_bucket and
+    get_website, SSM, BUCKET and WEBSITE still resolve on attribute access.
 """
 
 
@@ -11,10 +15,12 @@ import os
 import sys
 
 
-import boto3
 import diskcache
 
 
+from bf2pico.tiercache import TieredCache
+
+
 LOG = logging.getLogger(__name__)
 
 LOG_LEVEL = logging.INFO
@@ -33,8 +39,14 @@ CACHE = diskcache.Cache(
     )
 )
 
+# in process LRU in front of CACHE for hot, already decoded values
+HOT_CACHE = TieredCache(
+    CACHE,
+    max_bytes=int(os.getenv('BF2PICO_LRU_BYTES', str(16 * 1024 * 1024))),  # 16 MB
+    ttl=int(os.getenv('BF2PICO_LRU_TTL', '10'))  # 10 seconds
+)
 
-SSM = boto3.client('ssm')
+_SSM = {}
 
 
 PARAMETER_PREFIX = '/brewfather'
@@ -55,21 +67,74 @@ def get_parameter(name: str, default: str='') -> str:
     """
     cache_key = f'parameter-{name}'
     LOG.debug('Getting Pramater: %s <-----------------------------------', name)
-    if CACHE.get(cache_key, None):
-        return CACHE.get(cache_key)
+    cached = HOT_CACHE.get(cache_key, None)
+    if cached:
+        return cached
     try:
-        response = SSM.get_parameter(
+        response = get_ssm().get_parameter(
             Name=f'{PARAMETER_PREFIX}/{name}',
             WithDecryption=True
         )
         result = response['Parameter']['Value']
-        CACHE.set(cache_key, result, expire=PERSISTENT_CACHE_TIME)
+        HOT_CACHE.set(cache_key, result, expire=PERSISTENT_CACHE_TIME)
     except:  # pylint: disable=bare-except
         return default
     return result
 
 
-BUCKET = os.getenv('BUCKET', get_parameter('bucket'))
+def get_ssm() -> object:
+    """ I return the ssm client of this process, created on first use
+
+    Returns:
+        object: the boto3 ssm client
+    """
+    pid = os.getpid()
+    if pid not in _SSM:
+        import boto3  # pylint: disable=import-outside-toplevel
+        _SSM.clear()
+        _SSM[pid] = boto3.client('ssm')
+    return _SSM[pid]
+
+
+def get_bucket() -> str:
+    """ I return the bucket, the BUCKET environment variable or parameter
+
+    Returns:
+        str: the bucket name
+    """
+    return os.getenv('BUCKET', '') or get_parameter('bucket')
+
+
+def get_website() -> str:
+    """ I return the website the graphs and sessions are published on, the
+        WEBSITE environment variable or parameter
+
+    Returns:
+        str: the website url
+    """
+    return os.getenv('WEBSITE', '') or get_parameter('website')
+
+
+_LAZY = {
+    'BUCKET': get_bucket,
+    'SSM': get_ssm,
+    'WEBSITE': get_website,
+}
+
+
+def __getattr__(name: str) -> object:
+    """ I look up BUCKET, SSM and WEBSITE on first use, so importing the
+        package makes no parameter store call
+
+    Args:
+        name (str): the attribute of the package
+
+    Returns:
+        object: the value of the attribute
+    """
+    if name in _LAZY:
+        return _LAZY[name]()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 CACHE_TIME = int(os.getenv('BF2PICO_CACHE', '60')) # 1 min
@@ -81,10 +146,21 @@ MAX_SESSION_TIME = 60 * 60 * 24  # 1 day
 
 SESSION_MAX_IDLE = 60 * 60  # 1 hour
 
+# How many log events are stored in each session log segment object
+SESSION_SEGMENT_SIZE = int(os.getenv('BF2PICO_SEGMENT_SIZE', '60'))
+
+# How long and how many log events are buffered before writing them to s3
+SESSION_FLUSH_SECONDS = int(os.getenv('BF2PICO_FLUSH_SECONDS', '30'))
+SESSION_FLUSH_EVENTS = int(os.getenv('BF2PICO_FLUSH_EVENTS', '10'))
+
 # Length of time requests should wait for a response form brewfather
 REQUESTS_TIMEOUT = 2  # 2 seconds
 
-WEBSITE = os.getenv('WEBSITE',  get_parameter('website'))
+# How long a cached object is served before revalidating its etag
+CACHE_FRESHNESS = int(os.getenv('BF2PICO_CACHE_FRESHNESS', '60'))  # 1 min
+
+# gzip level for stored objects and their cache entries, 0 disables compression
+COMPRESS_LEVEL = int(os.getenv('BF2PICO_COMPRESS_LEVEL', '6'))
 
 if not os.getenv('AWS_RETRY_MODE', ''):
     os.environ['AWS_RETRY_MODE'] = 'adaptive'
@@ -5,17 +5,24 @@
 import base64
 import json
 import os
-import requests
+import threading
+import time
+
+
+from urllib3.util.retry import Retry
 
 
 from bf2pico import (
     CACHE,
     CACHE_TIME,
+    EPHEMERAL_CACHE_TIME,
     LOG,
     PARAMETER_PREFIX,
     REQUESTS_TIMEOUT,
-    pico,
+    catalog,
     prosaic,
+    recipemap,
+    singleflight,
 )
 
 
@@ -25,6 +32,227 @@ STATUS_OPTIONS = {
     'brewing': 'Brewing',
 }
 
+API_URL = 'https://api.brewfather.app/v2'
+
+LOG_URL = 'https://log.brewfather.net/stream?id=bVqW9nk4Pz3ro0'
+
+# How many times a failed brewfather call is retried
+REQUESTS_RETRIES = int(os.getenv('BF2PICO_REQUESTS_RETRIES', '3'))
+
+# The most seconds a 429 Retry-After from brewfather is honored
+REQUESTS_RETRY_AFTER_MAX = int(os.getenv('BF2PICO_REQUESTS_RETRY_AFTER_MAX', '5'))
+
+# How many connections to brewfather are kept alive per process
+REQUESTS_POOL_SIZE = int(os.getenv('BF2PICO_REQUESTS_POOL_SIZE', '10'))
+
+RECORDS_PER_CALL = 50
+
+
+class _Retry(Retry):
+    """ I am a urllib3 Retry which caps the wait asked by Retry-After at
+        REQUESTS_RETRY_AFTER_MAX, so a worker is not held for minutes.
+    """
+    def get_retry_after(self, response):
+        """ I return the seconds asked by Retry-After, at most
+            REQUESTS_RETRY_AFTER_MAX, None if it was not asked
+        """
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, REQUESTS_RETRY_AFTER_MAX)
+
+
+def _retry() -> _Retry:
+    """ I return the retry policy for brewfather calls
+    """
+    return _Retry(
+        total=REQUESTS_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        # the brew log stream is a POST and is not safe to repeat
+        allowed_methods=frozenset(['GET', 'PATCH']),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+
+_SESSION = {}
+_SESSION_LOCK = threading.Lock()
+
+
+def http_session() -> object:
+    """ I return the keep alive requests session of this process, requests
+        is imported on first use.
+
+    Returns:
+        requests.Session: a session with a pooled, retrying adapter
+    """
+    pid = os.getpid()
+    with _SESSION_LOCK:
+        if pid not in _SESSION:
+            # pylint: disable=import-outside-toplevel
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            _SESSION.clear()
+            adapter = HTTPAdapter(
+                pool_connections=2,
+                pool_maxsize=REQUESTS_POOL_SIZE,
+                max_retries=_retry(),
+            )
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({
+                'Accept': 'application/json',
+                'Accept-Encoding': 'gzip, deflate',
+            })
+            _SESSION[pid] = session
+        return _SESSION[pid]
+
+
+class BrewfatherClient:
+    """
+        I call the brewfather api for one user over the pooled session of
+        the process.
+
+        Args:
+            auth (str): the base64 auth string
+    """
+    def __init__(self, auth: str) -> object:
+        self.auth = auth
+        self.session = http_session()
+
+    def request(self, method: str, url: str, **kwargs) -> object:
+        """ I make an authenticated call and log how long it took
+
+        Args:
+            method (str): the http method
+            url (str): the full url or a path under API_URL
+
+        Returns:
+            requests.Response: the response
+        """
+        if '://' not in url:
+            url = f'{API_URL}/{url}'
+        headers = kwargs.pop('headers', {})
+        headers['authorization'] = f'Basic {self.auth}'
+        started = time.monotonic()
+        response = self.session.request(
+            method,
+            url,
+            headers=headers,
+            timeout=kwargs.pop('timeout', REQUESTS_TIMEOUT),
+            **kwargs
+        )
+        LOG.debug(
+            'brewfather %s %s returned %s in %.3fs',
+            method,
+            url.split('?', 1)[0],
+            response.status_code,
+            time.monotonic() - started
+        )
+        return response
+
+    def get(self, path: str, **params) -> object:
+        """ I return the decoded json of a GET
+
+        Args:
+            path (str): the path under API_URL
+
+        Returns:
+            object: the decoded json
+        """
+        response = self.request('GET', path, params=params)
+        LOG.debug('text = %s', response.text)
+        return json.loads(response.text)
+
+    def batches(self, status: str) -> list:
+        """ I return the batches with a status, a page at a time
+
+        Args:
+            status (str): the brewfather status, such as Planning
+
+        Returns:
+            list: the batches
+        """
+        result = []
+        params = {'limit': RECORDS_PER_CALL, 'status': status}
+        while True:
+            page = self.get('batches', **params)
+            if not isinstance(page, list):
+                raise ValueError(f'unexpected batches response {page}')
+            result += page
+            if len(page) < RECORDS_PER_CALL:
+                break
+            params['start_after'] = page[-1]['_id']
+        return result
+
+    def recipe(self, recipe_id: str) -> dict:
+        """ I return a recipe
+
+        Args:
+            recipe_id (str): The Brewfather recipe id
+
+        Returns:
+            dict: the recipe
+        """
+        return self.get(f'recipes/{recipe_id}')
+
+    def recipes(self, order_by: str='_id', start_after=None) -> list:
+        """ I return recipes, a page at a time
+
+        Args:
+            order_by (str): the field recipes are ordered and paged by
+            start_after: only return recipes after this value of order_by
+
+        Returns:
+            list: the recipes
+        """
+        result = []
+        params = {'limit': RECORDS_PER_CALL, 'order_by': order_by}
+        if order_by != '_id':
+            params['include'] = order_by
+        if start_after is not None:
+            params['start_after'] = start_after
+        while True:
+            page = self.get('recipes', **params)
+            if not isinstance(page, list):
+                raise ValueError(f'unexpected recipes response {page}')
+            result += page
+            if len(page) < RECORDS_PER_CALL:
+                break
+            params['start_after'] = page[-1][order_by]
+        return result
+
+    def change_batch_status(self, batch_id: str, status: str) -> object:
+        """ I set the status of a batch
+
+        Args:
+            batch_id (str): the batch to update
+            status (str): the brewfather status, such as Brewing
+
+        Returns:
+            requests.Response: the response
+        """
+        return self.request(
+            'PATCH',
+            f'batches/{batch_id}',
+            params={'status': status},
+            data={'status': status},
+        )
+
+    def stream_log(self, data: dict) -> object:
+        """ I post to the brewfather brew log stream
+
+        Args:
+            data (dict): the log record
+
+        Returns:
+            requests.Response: the response
+        """
+        return self.request('POST', LOG_URL, json=data)
+
 
 def get_batchs(auth: str, status='Planning') -> dict:
     """
@@ -44,22 +272,16 @@ def get_batchs(auth: str, status='Planning') -> dict:
 
     cache_key = f'{auth}-{status}-batchs'
 
-    if cache_key in CACHE:
-        return CACHE[cache_key]
+    def fetch() -> list:
+        result = BrewfatherClient(auth).batches(status)
+        CACHE.set(cache_key, result, expire=CACHE_TIME)
+        return result
 
-    response = requests.get(
-        'https://api.brewfather.app/v2/batches?limit=50&status=Planning',
-        timeout=REQUESTS_TIMEOUT,
-        headers={
-            'Content-Type': 'json',
-            'authorization': f'Basic {auth}'
-        }
+    return singleflight.do(
+        singleflight.flight_key('get_batchs', auth, status),
+        lambda: CACHE.get(cache_key, singleflight.MISSING),
+        fetch
     )
-    LOG.debug('status code = %s', response.status_code)
-    LOG.debug('text = %s', response.text)
-    result = json.loads(response.text)
-    CACHE.set(cache_key, result, expire=CACHE_TIME)
-    return result
 
 
 def get_recipe(auth: str, recipe_id: str) -> dict:
@@ -73,27 +295,45 @@ def get_recipe(auth: str, recipe_id: str) -> dict:
         dict: _description_
     """
     recipe_key = f'recipe-{recipe_id}'
-    recipe = CACHE.get(recipe_key, {})
-    if recipe:
+
+    def fetch() -> dict:
+        recipe = BrewfatherClient(auth).recipe(recipe_id)
+        if recipe.get('_id', None) == recipe_id:
+            CACHE.set(recipe_key, recipe, expire=EPHEMERAL_CACHE_TIME)
         return recipe
 
-    url = f'https://api.brewfather.app/v2/recipes/{recipe_id}'
-    response = requests.get(
-        url,
-        timeout=REQUESTS_TIMEOUT,
-        headers={
-            'Content-Type': 'json',
-            'authorization': f'Basic {auth}'
-        }
+    return singleflight.do(
+        singleflight.flight_key('get_recipe', auth, recipe_id),
+        lambda: CACHE.get(recipe_key, None) or singleflight.MISSING,
+        fetch
     )
-    LOG.debug('get recipe return code is %s', response.status_code)
-    LOG.debug('get recipe text is %s', response.text)
-    return json.loads(response.text)
+
+
+def forget_recipe(recipe_id: str) -> None:
+    """ I drop the cached copy of a recipe which changed in brewfather
+
+    Args:
+        recipe_id (str): The Brewfather recipe id
+    """
+    CACHE.delete(f'recipe-{recipe_id}')
+
+
+def auth_user_id(auth: str) -> str:
+    """ I return the brewfather user_id of an auth string
+
+    Args:
+        auth (str): the base64 auth string
+
+    Returns:
+        str: the user_id
+    """
+    return base64.b64decode(auth).decode('utf-8').split(':', 1)[0]
 
 
 def get_recipes(auth) -> dict:
     """
-        I get the all recipes from brewfather.
+        I get the all recipes from brewfather, through the recipe catalog of
+        the user.
 
         Args
             auth: the base64 auth string
@@ -101,43 +341,9 @@ def get_recipes(auth) -> dict:
         Returns: Dict of recipes with the key being the recipe name
                     and the value being the brewfather recipe.
     """
-    records_per_call = 50
-    recipe_key = f'{auth}-recipes'
-    recipes = CACHE.get(recipe_key, {})
-    if recipes:
-        return recipes
-
-    url = f'https://api.brewfather.app/v2/recipes?limit={records_per_call}'
-    response = requests.get(
-        url,
-        timeout=REQUESTS_TIMEOUT,
-        headers={
-            'Content-Type': 'json',
-            'authorization': f'Basic {auth}'
-        }
-    )
-    LOG.debug('get recipes return code is %s', response.status_code)
-    LOG.debug('get recipes text is %s', response.text)
-
-    loop_count = 0
-    while True:
-        count = 1
-        for recipe in json.loads(response.text):
-            recipes[recipe['name']] = recipe
-            count += 1
-        if count < records_per_call:
-            break
-        loop_count += 1
-        response = requests.get(
-            f'{url}&start_after={loop_count * records_per_call}',
-            timeout=REQUESTS_TIMEOUT,
-        )
-        LOG.debug('get recipes return code is %s', response.status_code)
-        LOG.debug('get recipes text is %s', response.text)
-
-    CACHE.set(f'{auth}recipes', recipes, expire=CACHE_TIME)
-
-    return recipes
+    recipes = catalog.get_catalog(auth_user_id(auth))
+    recipes.refresh(auth)
+    return recipes.by_name()
 
 
 def get_batch_recipe_map(user_id: str) -> dict:
@@ -205,6 +411,61 @@ def get_planning_recipe_map(user_id: str, planning: list, recipes: dict) -> dict
     return result
 
 
+def get_planning_recipe_id(user_id: str, batch_id: str) -> str:
+    """ I return the recipe_id of a batch from the planning map, looking in
+        the archive of compacted batches if it is not there.
+
+    Args:
+        user_id (str): the brewfather user_id
+        batch_id (str): the brewfather batch id
+
+    Returns:
+        str: the recipe_id, None if the batch is not mapped
+    """
+    result = get_batch_recipe_map(user_id).get(batch_id, None)
+    if result is None:
+        archived = prosaic.s3_get(f'planning_recipe_map_archive/{user_id}.json', '')
+        result = json.loads(archived).get(batch_id, None) if archived else None
+    return result
+
+
+def compact_planning_recipe_map(user_id: str, keep: set) -> int:
+    """ I move the batches which are not in keep from the planning map to
+        its archive.
+
+    Args:
+        user_id (str): the brewfather user_id
+        keep (set): the batch ids to keep, the planned and brewing batches
+
+    Returns:
+        int: how many batches were archived
+    """
+    result_key = f'planning_recipe_map/{user_id}.json'
+    archive = {
+        batch_id: recipe_id
+        for batch_id, recipe_id in get_batch_recipe_map(user_id).items()
+        if batch_id not in keep
+    }
+    if not archive:
+        return 0
+
+    def add(current: str) -> str:
+        result = json.loads(current) if current else {}
+        result.update(archive)
+        return json.dumps(result)
+
+    def remove(current: str) -> str:
+        result = json.loads(current) if current else {}
+        for batch_id in archive:
+            result.pop(batch_id, None)
+        return json.dumps(result)
+
+    prosaic.s3_update(f'planning_recipe_map_archive/{user_id}.json', add, '')
+    prosaic.s3_update(result_key, remove, '')
+    LOG.info('archived %s planning batches of %s', len(archive), user_id)
+    return len(archive)
+
+
 def get_recipe_from_batch_id(creds: object, batch_id: str) -> dict:
     """ I return the brewfather recipe for a given batch_id
 
@@ -215,12 +476,9 @@ def get_recipe_from_batch_id(creds: object, batch_id: str) -> dict:
     Returns:
         dict: brewfather dict of the recipe
     """
-    # batch_recipe_map =  get_batch_recipe_map(creds.user_id)
-    recipe_map = pico.get_list_recipes_map(creds.user_id)
     LOG.debug('batch_id is %s', batch_id)
-    LOG.debug('recipe_map')
-    LOG.debug(json.dumps(recipe_map, indent=2))
-    recipe_id = recipe_map['by_batch_id'].get(batch_id, {'recipe_id': None})['recipe_id']
+    entry = recipemap.get_recipe_map(creds.user_id).by_batch(batch_id)
+    recipe_id = entry['recipe_id'] if entry else None
     LOG.debug('recipe_id is %s', str(recipe_id))
     if not recipe_id:
         LOG.info('Unable to find recipe from batch')
@@ -237,24 +495,8 @@ def change_batch_status(creds: object, batch_id: str, status: str) -> None:
         status (str): the new status either (planning, brewing, or fermenting)
         _id (str): _description_
     """
-    status_options = {
-        'planning': 'Planning',
-        'fermenting': 'Fermenting',
-        'brewing': 'Brewing'
-    }
-    new_status = status_options[status.lower()]
-    url = f'https://api.brewfather.app/v2/batches/{batch_id}?status={new_status}'
-    response = requests.patch(
-        url,
-        data={
-            'status': new_status,
-        },
-        timeout=REQUESTS_TIMEOUT,
-        headers={
-            'Content-Type': 'json',
-            'authorization': f'Basic {creds.auth()}'
-        }
-    )
+    new_status = STATUS_OPTIONS[status.lower()]
+    response = BrewfatherClient(creds.auth()).change_batch_status(batch_id, new_status)
     LOG.debug(response.status_code)
     LOG.debug(response.text)
 
@@ -268,14 +510,8 @@ def update_brgewlog(creds, name: str, comment: str) -> None:
         comment (str): the comment to add
         name (str): the beer name
     """
-    response = requests.post(
-        "https://log.brewfather.net/stream?id=bVqW9nk4Pz3ro0",
-        headers={
-            'Content-Type': 'application/json',
-            'authorization': f'Basic {creds.auth()}'
-        },
-        timeout=REQUESTS_TIMEOUT,
-        json={
+    response = BrewfatherClient(creds.auth()).stream_log(
+        {
             'name': 'bf2pico',
             "temp": 20.32,
             'beer': name,
@@ -1,21 +1,42 @@
 """ I plot a brew based on a session log.
+
+    The graph is a png drawn with matplotlib, or a svg drawn by svgplot
+    with only the standard library. matplotlib and numpy are imported
+    when a png is drawn, not when I am imported.
 """
 
 
 import argparse
 import json
+import os
+import resource
 import time
 import traceback
 
 
-import matplotlib.pyplot as plt
-
-
 from bf2pico import (
     LOG,
+    downsample,
 )
 
 
+# the graph format, png or svg
+GRAPH_FORMAT = os.getenv('BF2PICO_GRAPH_FORMAT', 'png').lower()
+
+GRAPH_FORMATS = ['png', 'svg']
+
+# series longer than this are drawn without markers
+MARKER_MAX_POINTS = int(os.getenv('BF2PICO_MARKER_MAX_POINTS', '200'))
+
+# the session log key, color and label of each line
+SERIES = [
+    ('WortTemp', 'g', 'Wort Temp'),
+    ('ThermoBlockTemp', 'r', 'Heat Temp'),
+    ('DrainTemp', 'b', 'Drain Temp'),
+    ('TargetTemp', 'y', 'Target Temp'),
+]
+
+
 def load_session(filename: str) -> dict:
     """ Load the session file
 
@@ -30,17 +51,57 @@ def load_session(filename: str) -> dict:
 
 
 def celsius_to_fahrenheit(temp: float) -> float:
-    """_summary_
+    """ I convert celsius to fahrenheit, a number or a numpy array
 
     Args:
-        temp (float): _description_
+        temp (float): the temperature in celsius
 
     Returns:
-        float: _description_
+        float: the temperature in fahrenheit
     """
     return temp * 1.8 + 32
 
 
+def graph_filename(session_id: str) -> str:
+    """ I return the local file the graph of a session is written to
+
+    Args:
+        session_id (str): the session index, {user_id}-{session_id}
+
+    Returns:
+        str: the filename, with the extension of GRAPH_FORMAT
+    """
+    return f'data/{session_id}.{GRAPH_FORMAT}'
+
+
+def time_range(logs: list) -> str:
+    """ I return the brew date and the start and stop time of a session
+
+    Args:
+        logs: the SessionLogs
+
+    Returns:
+        str: the time range, empty if the session has no logs
+    """
+    try:
+        start_epoch = logs[0]['epoch']
+        start_time = time.strftime('%H:%M', time.localtime(start_epoch))
+        stop_epoch = logs[len(logs) -1]['epoch']
+        stop_time = time.strftime('%H:%M', time.localtime(stop_epoch))
+        brew_date = time.strftime('%Y-%m', time.localtime(start_epoch))
+        return f'{brew_date} {start_time} - {stop_time}'
+    except Exception:  # pylint: disable=broad-exception-caught
+        print('Brewplot failure')
+        LOG.error(str(traceback.format_exc()))
+        return ''
+
+
+def _peak_rss() -> float:
+    """ I return the peak resident memory of the process in MB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
 def _options() -> object:
     """ I provide the argparse option set.
 
@@ -58,65 +119,137 @@ def _options() -> object:
         default='',
         help='the file to plot'
     )
+    parser.add_argument(
+        '--format',
+        default=None,
+        choices=GRAPH_FORMATS,
+        help='the graph format, from the --save extension or BF2PICO_GRAPH_FORMAT if not given'
+    )
     return parser.parse_args()
 
 
-def create_graph(data: dict, filename: str):
+def graph_format(filename: str) -> str:
+    """ I return the format of a graph file, from its extension
+
+    Args:
+        filename (str): the graph file
+
+    Returns:
+        str: png or svg, GRAPH_FORMAT if the extension is neither
+    """
+    extension = os.path.splitext(filename)[1].lstrip('.').lower()
+    return extension if extension in GRAPH_FORMATS else GRAPH_FORMAT
+
+
+def create_graph(data: dict, filename: str, fmt: str=None):
     """ I create the graph
 
     Args:
         data: dict of the session data
-        filename: the file to write the graph.
+        filename: the file to write the graph, shown on screen if empty.
+        fmt: png or svg, from the extension of filename if not given
     """
-    count = 1
-    x_axis = []
-    wort_temp = []
-    heat_temp = []
-    drain_temp = []
-    target_temp = []
-
-    for record in data.get('SessionLogs', []):
-        x_axis.append(count)
-        wort_temp.append(celsius_to_fahrenheit(record['WortTemp']))
-        heat_temp.append(celsius_to_fahrenheit(record['ThermoBlockTemp']))
-        drain_temp.append(celsius_to_fahrenheit(record['DrainTemp']))
-        target_temp.append(celsius_to_fahrenheit(record['TargetTemp']))
-        if count == 1:
-            plt.legend()
-        count += 1
-
-    plt.plot(x_axis, wort_temp, color = 'g', linestyle = 'solid',
-            marker = 'o',label = "Wort Temp")
-    plt.plot(x_axis, heat_temp, color = 'r', linestyle = 'solid',
-            marker = 'o',label = "Heat Temp")
-    plt.plot(x_axis, drain_temp, color = 'b', linestyle = 'solid',
-            marker = 'o',label = "Drain Temp")
-    plt.plot(x_axis, target_temp, color = 'y', linestyle = 'solid',
-            marker = 'o',label = "Target Temp")
-
-    plt.xticks(rotation = 25)
-    plt.ylabel('Temperature(°F)')
-    name = data.get('Name', 'unknown')
-    try:
-        start_epoch = data['SessionLogs'][0]['epoch']
-        start_time = time.strftime('%H:%M', time.localtime(start_epoch))
-        stop_epoch = data['SessionLogs'][len(data['SessionLogs']) -1]['epoch']
-        stop_time = time.strftime('%H:%M', time.localtime(stop_epoch))
-        brew_date = time.strftime('%Y-%m', time.localtime(start_epoch))
-        plt.xlabel(f'{brew_date} {start_time} - {stop_time}')
-    except Exception:  # pylint: disable=broad-exception-caught
-        print('Brewplot failure')
-        LOG.error(str(traceback.format_exc()))
+    if (fmt or graph_format(filename)) == 'svg':
+        from bf2pico import svgplot  # pylint: disable=import-outside-toplevel
+        svgplot.create_graph(data, filename)
+    else:
+        _create_png(data, filename)
+
+
+def _figure(filename: str) -> object:
+    """ I return the figure to draw on, not registered with pyplot when it
+        is saved, so it is freed once drawn rather than kept for the life
+        of the process.
+
+    Args:
+        filename: the file the graph is written to, shown on screen if empty.
+
+    Returns:
+        matplotlib.figure.Figure: the figure
+    """
+    if filename:
+        # pylint: disable=import-outside-toplevel
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        figure = Figure()
+        FigureCanvasAgg(figure)
+        return figure
+    from matplotlib import pyplot  # pylint: disable=import-outside-toplevel
+    return pyplot.figure()
+
 
-    plt.title(
-        name,
+def _plot_series(axes: object, series: dict) -> None:
+    """ I plot a line per SERIES, with markers on short sessions
+
+    Args:
+        axes: the matplotlib axes to plot on
+        series (dict): the downsampled session, see downsample.sample
+    """
+    import numpy  # pylint: disable=import-outside-toplevel
+    x_axis = numpy.array(series['index'])
+    marker = 'o' if len(x_axis) <= MARKER_MAX_POINTS else None
+    for key, color, label in SERIES:
+        axes.plot(
+            x_axis,
+            celsius_to_fahrenheit(numpy.array(series[key], dtype=float)),
+            color=color,
+            linestyle='solid',
+            marker=marker,
+            label=label
+        )
+
+
+def _label_axes(axes: object, data: dict) -> None:
+    """ I add the title, axis labels, grid and legend
+
+    Args:
+        axes: the matplotlib axes to label
+        data: dict of the session data
+    """
+    logs = data.get('SessionLogs', [])
+    axes.tick_params(axis='x', labelrotation=25)
+    axes.set_ylabel('Temperature(°F)')
+    axes.set_xlabel(time_range(logs))
+    axes.set_title(
+        data.get('Name', 'unknown'),
         fontsize = 20
     )
-    plt.grid()
+    axes.grid()
+    if logs:
+        axes.legend()
+
+
+def _create_png(data: dict, filename: str):
+    """ I create the graph as a png with matplotlib
+
+    Args:
+        data: dict of the session data
+        filename: the file to write the graph, shown on screen if empty.
+    """
+    started = time.monotonic()
+    logs = data.get('SessionLogs', [])
+    series = downsample.sample(logs, [key for key, _, _ in SERIES])
+
+    figure = _figure(filename)
+    axes = figure.add_subplot()
+    _plot_series(axes, series)
+    _label_axes(axes, data)
+
     if filename:
-        plt.savefig(filename)
+        figure.savefig(filename)
+        figure.clear()
     else:
-        plt.show()
+        from matplotlib import pyplot  # pylint: disable=import-outside-toplevel
+        pyplot.show()
+        pyplot.close(figure)
+
+    LOG.info(
+        'graph of %s points (%s events) rendered in %.3fs, peak rss %.1f MB',
+        len(series['index']),
+        len(logs),
+        time.monotonic() - started,
+        _peak_rss()
+    )
 
 
 def main():
@@ -124,7 +257,7 @@ def main():
     """
     args = _options()
     data = load_session(args.filename)
-    create_graph(data, args.save)
+    create_graph(data, args.save, args.format)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,254 @@
+"""
+    I provide the recipe catalog of a brewfather user.
+
+    The catalog is kept in recipe_catalog/{user_id}.json and synced
+    incrementally, only recipes changed since the last sync are fetched by
+    ordering on _timestamp_ms. A full sync every BF2PICO_CATALOG_FULL_SYNC
+    seconds drops recipes deleted in brewfather. Once the catalog exists a
+    stale catalog is served while it is synced in the background.
+"""
+
+
+import json
+import os
+import threading
+import time
+
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+from bf2pico import (
+    CACHE,
+    CACHE_TIME,
+    LOG,
+    brewfather,
+    pico,
+    prosaic,
+    singleflight,
+)
+
+
+# seconds before the catalog is synced again
+CATALOG_SYNC_SECONDS = int(os.getenv('BF2PICO_CATALOG_SYNC', '300'))  # 5 min
+
+# seconds between full syncs of the catalog
+CATALOG_FULL_SYNC_SECONDS = int(os.getenv('BF2PICO_CATALOG_FULL_SYNC', str(60 * 60 * 24)))  # 1 day
+
+ORDER_BY = '_timestamp_ms'
+
+
+def _empty() -> dict:
+    return {
+        'cursor': None,
+        'synced': 0,
+        'full_synced': 0,
+        'recipes': {},
+    }
+
+
+class RecipeCatalog:
+    """
+        I am the recipes of a brewfather user with an index by name.
+
+        Args:
+            user_id (str): the brewfather user_id
+    """
+    def __init__(self, user_id: str) -> object:
+        self.user_id = user_id
+        self.key = f'recipe_catalog/{user_id}.json'
+        self.data = _empty()
+        self.names = {}
+        self.loaded = 0
+        self.load()
+
+    def _index(self, data: dict) -> None:
+        self.data = data
+        self.names = {
+            recipe['name']: recipe_id
+            for recipe_id, recipe in data['recipes'].items()
+        }
+
+    def load(self) -> None:
+        """ I read the catalog from storage
+        """
+        self._index(json.loads(prosaic.s3_get(self.key, '') or json.dumps(_empty())))
+        self.loaded = time.time()
+
+    @property
+    def stale(self) -> bool:
+        """ True when the catalog is due a sync
+        """
+        return time.time() - self.data['synced'] > CATALOG_SYNC_SECONDS
+
+    def recipe_id(self, name: str) -> str:
+        """ I return the id of a recipe by name
+
+        Args:
+            name (str): the recipe name
+
+        Returns:
+            str: the recipe id, None if it is not in the catalog
+        """
+        return self.names.get(name, None)
+
+    def stamp(self, recipe_id: str) -> int:
+        """ I return when a recipe last changed
+
+        Args:
+            recipe_id (str): the recipe id
+
+        Returns:
+            int: the _timestamp_ms of the recipe, None if it is not known
+        """
+        return self.data['recipes'].get(recipe_id, {}).get(ORDER_BY, None)
+
+    def by_name(self) -> dict:
+        """ I return the recipes by name, like brewfather.get_recipes
+
+        Returns:
+            dict: recipe name to recipe
+        """
+        names, recipes = self.names, self.data['recipes']
+        return {
+            name: recipes[recipe_id]
+            for name, recipe_id in names.items()
+            if recipe_id in recipes
+        }
+
+    def sync(self, auth: str, full: bool=False) -> list:
+        """ I fetch the recipes changed since the last sync and save them
+
+        Args:
+            auth (str): the base64 auth string
+            full (bool): fetch every recipe, dropping deleted ones
+
+        Returns:
+            list: the ids of the recipes which were added or changed
+        """
+        now = time.time()
+        full = full or now - self.data['full_synced'] > CATALOG_FULL_SYNC_SECONDS
+        fetched = brewfather.BrewfatherClient(auth).recipes(
+            order_by=ORDER_BY,
+            start_after=None if full else self.data['cursor']
+        )
+        changed = [
+            recipe['_id']
+            for recipe in fetched
+            if self.data['recipes'].get(recipe['_id'], None) != recipe
+        ]
+        LOG.debug(
+            'recipe catalog %s fetched %s recipes, %s changed',
+            self.user_id,
+            len(fetched),
+            len(changed)
+        )
+
+        def merge(current: str) -> str:
+            result = json.loads(current) if current else _empty()
+            if full:
+                result['recipes'] = {}
+                result['full_synced'] = now
+            for recipe in fetched:
+                result['recipes'][recipe['_id']] = recipe
+                if recipe.get(ORDER_BY, None) is not None:
+                    result['cursor'] = max(result['cursor'] or 0, recipe[ORDER_BY])
+            result['synced'] = now
+            return json.dumps(result)
+
+        self._index(json.loads(prosaic.s3_update(self.key, merge, '')))
+        self.loaded = time.time()
+        for recipe_id in changed:
+            brewfather.forget_recipe(recipe_id)
+            pico.forget_program(recipe_id)
+        return changed
+
+    def refresh(self, auth: str) -> None:
+        """ I sync the catalog, in the background unless it has never been synced
+
+        Args:
+            auth (str): the base64 auth string
+        """
+        if not self.data['synced']:
+            # the first sync of a user is waited on, do it once
+            def lookup():
+                self.load()
+                return self.data['synced'] or singleflight.MISSING
+
+            singleflight.do(
+                singleflight.flight_key('catalog', self.user_id),
+                lookup,
+                lambda: self.sync(auth)
+            )
+        elif self.stale:
+            sync_in_background(self, auth)
+
+
+_CATALOGS = {}
+
+_CATALOGS_LOCK = threading.Lock()
+
+_EXECUTOR = {}
+
+_SYNCING = set()
+
+_SYNCING_LOCK = threading.Lock()
+
+
+def _executor() -> ThreadPoolExecutor:
+    pid = os.getpid()
+    if pid not in _EXECUTOR:
+        _EXECUTOR.clear()
+        _EXECUTOR[pid] = ThreadPoolExecutor(
+            max_workers=2,
+            thread_name_prefix='bf2pico-catalog'
+        )
+    return _EXECUTOR[pid]
+
+
+def sync_in_background(recipes: RecipeCatalog, auth: str) -> None:
+    """ I sync a catalog on a background thread, once per user across the
+        workers of this host.
+
+    Args:
+        recipes (RecipeCatalog): the catalog to sync
+        auth (str): the base64 auth string
+    """
+    with _SYNCING_LOCK:
+        if recipes.user_id in _SYNCING:
+            return
+        guard = f'catalog-sync-{recipes.user_id}'
+        if not CACHE.add(guard, os.getpid(), expire=60):
+            return
+        _SYNCING.add(recipes.user_id)
+
+    def run() -> None:
+        try:
+            recipes.sync(auth)
+        except Exception as err_msg:  # pylint: disable=broad-exception-caught
+            LOG.info('recipe catalog %s sync failed: %s', recipes.user_id, err_msg)
+        finally:
+            CACHE.delete(guard)
+            with _SYNCING_LOCK:
+                _SYNCING.discard(recipes.user_id)
+
+    _executor().submit(run)
+
+
+def get_catalog(user_id: str) -> RecipeCatalog:
+    """ I return the recipe catalog of a user, shared within the process
+
+    Args:
+        user_id (str): the brewfather user_id
+
+    Returns:
+        RecipeCatalog: the catalog of the user
+    """
+    with _CATALOGS_LOCK:
+        if user_id not in _CATALOGS:
+            _CATALOGS[user_id] = RecipeCatalog(user_id)
+            return _CATALOGS[user_id]
+        result = _CATALOGS[user_id]
+    if time.time() - result.loaded > CACHE_TIME:
+        result.load()
+    return result
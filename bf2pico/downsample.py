@@ -0,0 +1,187 @@
+"""
+    I downsample session logs for graphs with largest triangle three
+    buckets (LTTB), keeping the shape of the temperature lines.
+
+    One set of events is picked for every series so the lines stay aligned,
+    the triangle areas of the series are summed after scaling each series
+    to its range. The first and last events, every step change and the
+    highest and lowest value of each series are always kept, so overshoots
+    and steps are never smoothed away. Only the standard library is used,
+    so the result can be shared by every renderer.
+"""
+
+
+import os
+
+
+# how many points a session graph is reduced to, 0 keeps every point
+GRAPH_POINTS = int(os.getenv('BF2PICO_GRAPH_POINTS', '1000'))
+
+
+def column(logs, name: str) -> list:
+    """ I return the values of one key of the session log events
+
+    Args:
+        logs: the SessionLogs, a columnar container or a list of dicts
+        name (str): the key to return
+
+    Returns:
+        list: the values, one per event, None where it is missing
+    """
+    if hasattr(logs, 'column'):
+        return logs.column(name)
+    return [record.get(name, None) for record in logs]
+
+
+def _number(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _mean(values: list) -> float:
+    values = [value for value in values if value is not None]
+    return sum(values) / len(values) if values else None
+
+
+def lttb(series: list, threshold: int) -> list:
+    """ I pick the events which best keep the shape of the series
+
+    Args:
+        series (list): lists of numbers or None, all of the same length
+        threshold (int): how many events to pick
+
+    Returns:
+        list: the picked indices, in order
+    """
+    length = len(series[0]) if series else 0
+    if threshold >= length or threshold < 3:
+        return list(range(length))
+
+    scales = []
+    for values in series:
+        known = [value for value in values if value is not None]
+        spread = max(known) - min(known) if known else 0
+        scales.append(spread or 1.0)
+
+    result = [0]
+    every = (length - 2) / (threshold - 2)
+    for bucket in range(threshold - 2):
+        stop = int((bucket + 1) * every) + 1
+        next_stop = min(int((bucket + 2) * every) + 1, length)
+        result.append(_largest_triangle(
+            series,
+            scales,
+            result[-1],
+            range(int(bucket * every) + 1, stop),
+            ((stop + next_stop - 1) / 2, [_mean(values[stop:next_stop]) for values in series])
+        ))
+    result.append(length - 1)
+    return result
+
+
+def _largest_triangle(series: list, scales: list, anchor: int, bucket: range,
+        following: tuple) -> int:
+    """ I pick the event of a bucket making the largest triangle with the
+        last picked event and the average of the following bucket
+
+    Args:
+        series (list): lists of numbers or None, all of the same length
+        scales (list): the range of each series
+        anchor (int): the index of the last picked event
+        bucket (range): the indices of the bucket
+        following (tuple): (x, [y of each series]) the average of the following bucket
+
+    Returns:
+        int: the picked index
+    """
+    best, best_area = bucket[0], -1.0
+    for index in bucket:
+        area = _area(series, scales, (anchor, index), following)
+        if area > best_area:
+            best, best_area = index, area
+    return best
+
+
+def _area(series: list, scales: list, points: tuple, following: tuple) -> float:
+    """ I return the area of the triangles of an event, summed over the
+        series after scaling each to its range
+
+    Args:
+        series (list): lists of numbers or None, all of the same length
+        scales (list): the range of each series
+        points (tuple): (anchor, index) the last picked event and the candidate
+        following (tuple): (x, [y of each series]) the average of the following bucket
+
+    Returns:
+        float: the area
+    """
+    anchor, index = points
+    next_x, next_y = following
+    result = 0.0
+    for values, scale, average in zip(series, scales, next_y):
+        anchor_y, value = values[anchor], values[index]
+        if anchor_y is None or value is None or average is None:
+            continue
+        result += abs(
+            (anchor - next_x) * (value - anchor_y)
+            - (anchor - index) * (average - anchor_y)
+        ) / scale
+    return result
+
+
+def keep_indices(series: list, steps: list) -> set:
+    """ I return the events which must be kept, the step changes and the
+        extremes of each series
+
+    Args:
+        series (list): lists of numbers or None, all of the same length
+        steps (list): the step name of each event
+
+    Returns:
+        set: the indices
+    """
+    result = {
+        index
+        for index in range(1, len(steps))
+        if steps[index] != steps[index - 1]
+    }
+    for values in series:
+        known = [(value, index) for index, value in enumerate(values) if value is not None]
+        if known:
+            result.add(min(known)[1])
+            result.add(max(known)[1])
+    return result
+
+
+def sample(logs, keys: list, points: int=GRAPH_POINTS, step_key: str='StepName') -> dict:
+    """ I return the downsampled series of a session log
+
+    Args:
+        logs: the SessionLogs, a columnar container or a list of dicts
+        keys (list): the numeric keys to return and to shape the sample on
+        points (int): how many points to reduce to, 0 keeps every point
+        step_key (str): the key whose changes are always kept
+
+    Returns:
+        dict: 'index', the 1 based event numbers, 'epoch' and each of keys
+            to a list of values, the values converted to float or None
+    """
+    series = [[_number(value) for value in column(logs, key)] for key in keys]
+    length = len(series[0]) if series else len(logs)
+    if points and length > points:
+        indices = set(lttb(series, points))
+        indices |= keep_indices(series, column(logs, step_key))
+        indices = sorted(indices)
+    else:
+        indices = list(range(length))
+
+    epochs = column(logs, 'epoch')
+    result = {
+        'index': [index + 1 for index in indices],
+        'epoch': [epochs[index] for index in indices],
+    }
+    for key, values in zip(keys, series):
+        result[key] = [values[index] for index in indices]
+    return result
@@ -8,11 +8,16 @@ import os
 import time
 
 
-import boto3
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    wait,
+)
 
 
 from bf2pico import (
-    BUCKET,
+    CACHE,
+    EPHEMERAL_CACHE_TIME,
     LOG,
     MAX_SESSION_TIME,
     PARAMETER_PREFIX,
@@ -21,10 +26,22 @@ from bf2pico import (
     brewplot,
     pico,
     prosaic,
+    recipemap,
+    registry,
     session,
 )
 
 
+# render and close out worker processes
+RENDER_WORKERS = int(os.getenv('BF2PICO_RENDER_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+# how many sessions may be queued for the render workers at a time
+RENDER_QUEUE = int(os.getenv('BF2PICO_RENDER_QUEUE', str(RENDER_WORKERS * 2)))
+
+# how many runs a failing close out is tried before the session is given up
+CLOSE_OUT_ATTEMPTS = int(os.getenv('BF2PICO_CLOSE_OUT_ATTEMPTS', '5'))
+
+
 def is_finished(_session: str, data: dict) -> bool:
     """ figure out if a session is still active
 
@@ -56,68 +73,132 @@ def is_finished(_session: str, data: dict) -> bool:
     return False
 
 
-def settle_active() -> None:  # pylint: disable=too-many-locals
+def close_out(user_id: str, session_id: str) -> None:
+    """ I render the graph of a finished session once and close it out
+        with it, I run in a render worker process.
+
+    Args:
+        user_id (str): the brewfather user_id
+        session_id (str): the session index, {user_id}-{session_id}
+    """
+    try:
+        pico_id = session_id.split('-')[1]
+        session_key = f'sessions/{user_id}/{pico_id}.json'
+        _session = session.load_session(session_key, {})
+
+        if not os.path.exists('data'):
+            os.makedirs('data', exist_ok=True)
+        local_graph = brewplot.graph_filename(session_id)
+        brewplot.create_graph(_session, local_graph)
+        LOG.info('Graph Created %s', local_graph)
+        session.close_brewing(user_id, session_id, _session, local_graph=local_graph)
+    except IndexError:
+        pass
+
+
+def close_out_all(finished: list) -> list:
+    """ I close out finished sessions on a pool of render worker processes,
+        matplotlib is cpu bound and not thread safe. At most RENDER_QUEUE
+        sessions are queued at a time.
+
+    Args:
+        finished (list): (user_id, session_id) of the sessions to close out
+
+    Returns:
+        list: (user_id, session_id) of the sessions to remove from finished,
+            those closed out and those which failed CLOSE_OUT_ATTEMPTS times
+    """
+    if not finished:
+        return []
+    result = []
+    pending = {}
+
+    def collect(done: set) -> None:
+        for future in done:
+            job = pending.pop(future)
+            attempts_key = f'close-out-attempts-{job[1]}'
+            try:
+                future.result()
+                result.append(job)
+                CACHE.delete(attempts_key)
+            except Exception as err_msg:  # pylint: disable=broad-exception-caught
+                attempts = CACHE.incr(attempts_key, default=0)
+                CACHE.touch(attempts_key, expire=EPHEMERAL_CACHE_TIME)
+                if attempts < CLOSE_OUT_ATTEMPTS:
+                    LOG.exception(
+                        'unable to close out %s (attempt %s of %s), retrying on the next run',
+                        job[1],
+                        attempts,
+                        CLOSE_OUT_ATTEMPTS
+                    )
+                    continue
+                LOG.exception('giving up closing out %s after %s attempts', job[1], attempts)
+                # keep why for a look, the session is no longer retried
+                prosaic.s3_put(
+                    json.dumps({
+                        'error': repr(err_msg),
+                        'attempts': attempts,
+                        'epoch': time.time(),
+                    }),
+                    f'close-out-failed/{job[0]}/{job[1]}.json'
+                )
+                CACHE.delete(attempts_key)
+                result.append(job)
+
+    with ProcessPoolExecutor(max_workers=RENDER_WORKERS) as pool:
+        for job in finished:
+            if len(pending) >= RENDER_QUEUE:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending[pool.submit(close_out, *job)] = job
+        done, _ = wait(pending)
+        collect(done)
+    return result
+
+
+def settle_active() -> None:
     """ I loop through the active sessions and if there isn't seconds remaining
-        move them to finished sessions.
+        move them to finished sessions, then close out the finished sessions.
     """
     LOG.debug('running settle_active')
+    session.flush_pending()
 
     users = prosaic.get_parameters(f'{PARAMETER_PREFIX}/users/')
-    s3_client = boto3.client('s3')
+    finished = []
     for user_id in users:
-        active_key = f'active-sessions/{user_id}.json'
-        finished_key = f'finished-sessions/{user_id}.json'
-
-        active_sessions = json.loads(prosaic.s3_get(active_key, '[]'))
-        finished_sessions = json.loads(prosaic.s3_get(finished_key, '[]'))
+        sessions = registry.get_registry(user_id)
+        sessions.load()
 
-        LOG.info('Active sessions is %s', json.dumps(active_sessions))
-        LOG.info('Finished sessions is %s', json.dumps(finished_sessions))
+        LOG.info('Active sessions is %s', json.dumps(sessions.active))
+        LOG.info('Finished sessions is %s', json.dumps(sessions.finished))
 
-        for _session in active_sessions:
+        for _session in list(sessions.active):
             LOG.info('Session is (%s)', _session)
             session_key = f"sessions/{_session.replace('-', '/')}.json"
-            data = json.loads(prosaic.s3_get(session_key, '{}'))
+            data = session.load_session(session_key, {})
 
             if is_finished(_session, data):
                 LOG.info('moving %s from active to finished', _session)
-                active_sessions.remove(_session)
-                finished_sessions.append(_session)
+                sessions.finish(_session)
 
                 if data.get('Name', 'RINSE') != 'RINSE':
                     LOG.debug('Changing Batch %s to fermenting', data['Pico_Id'])
                     creds = brewfather.BrewAuth(device_id=data['device_id'])
                     pico.change_batch_state(creds, data['Pico_Id'], 'fermenting')
 
-        prosaic.s3_put(json.dumps(active_sessions), active_key)
+        sessions.save()
+        finished += [(user_id, session_id) for session_id in sessions.finished]
 
-        # running active sessions
-        for session_id in finished_sessions:
-            try:
-                pico_id = session_id.split('-')[1]
-                session_key = f'sessions/{user_id}/{pico_id}.json'
-                _session = json.loads(prosaic.s3_get(session_key, '{}'))
-
-                if not os.path.exists('data'):
-                    os.makedirs('data')
-                local_graph =  f'data/{session_id}.png'
-                brewplot.create_graph(_session, local_graph)
-                LOG.info('Graph Created %s', local_graph)
-                year_month_day = time.strftime('%Y-%m-%d', time.localtime(int(time.time())))
-                graph_key = f'graphs/{user_id}/{year_month_day}/{session_id}.png'
-                response = s3_client.upload_file(
-                    local_graph,
-                    BUCKET,
-                    graph_key
-                )
-                LOG.debug(json.dumps(response, default=str))
-                session.close_brewing(user_id, session_id, _session)
-            except IndexError:
-                pass
+    for user_id, session_id in close_out_all(finished):
+        registry.get_registry(user_id).close(session_id)
 
-            finished_sessions.pop(0)
+    for user_id in users:
+        registry.get_registry(user_id).save()
 
-        prosaic.s3_put(json.dumps(finished_sessions), finished_key)
+        try:
+            recipemap.compact_user(brewfather.BrewAuth(user_id=user_id))
+        except Exception as err_msg:  # pylint: disable=broad-exception-caught
+            LOG.info('unable to compact the recipe maps of %s: %s', user_id, err_msg)
 
 
 def _options() -> object:
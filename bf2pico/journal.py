@@ -0,0 +1,193 @@
+"""
+    I provide the request journal for the webapp.
+
+    Requests are queued in memory and a background thread appends them in
+    batches as json lines to data/journal-{pid}.jsonl. The journal is rotated
+    by size and age, rotated files can be gzip compressed and only the newest
+    BF2PICO_JOURNAL_KEEP rotated files are kept.
+"""
+
+
+import atexit
+import glob
+import gzip
+import json
+import os
+import queue
+import random
+import shutil
+import threading
+import time
+
+
+from bf2pico import (
+    LOG,
+)
+
+
+JOURNAL_PATH = os.getenv('BF2PICO_JOURNAL_PATH', 'data')
+
+JOURNAL_MAX_BYTES = int(os.getenv('BF2PICO_JOURNAL_MAX_BYTES', str(10 * 1024 * 1024)))  # 10 MB
+
+JOURNAL_MAX_AGE = int(os.getenv('BF2PICO_JOURNAL_MAX_AGE', '3600'))  # 1 hour
+
+JOURNAL_KEEP = int(os.getenv('BF2PICO_JOURNAL_KEEP', '48'))
+
+JOURNAL_COMPRESS = os.getenv('BF2PICO_JOURNAL_COMPRESS', 'true').lower() in ('1', 'true', 'yes')
+
+# fraction of healthy requests to journal, unmatched requests are always kept
+JOURNAL_SAMPLE_RATE = float(os.getenv('BF2PICO_JOURNAL_SAMPLE_RATE', '1.0'))
+
+# how long the writer waits to batch requests together
+JOURNAL_BATCH_SECONDS = 1
+
+JOURNAL_QUEUE_SIZE = 10000
+
+
+class RequestJournal:
+    """
+        I append requests to a rotating json lines journal from a background
+        thread.
+
+        Args:
+            path (str): the directory for the journal files
+    """
+    def __init__(self, path: str=JOURNAL_PATH) -> object:
+        self.path = path
+        self.pid = os.getpid()
+        self.queue = queue.Queue(maxsize=JOURNAL_QUEUE_SIZE)
+        self.dropped = 0
+        self.opened = 0
+        self._handler = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='bf2pico-journal',
+            daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def filename(self) -> str:
+        """ the journal file being written
+        """
+        return os.path.join(self.path, f'journal-{self.pid}.jsonl')
+
+    def record(self, data: dict, healthy: bool=True) -> None:
+        """ I queue a request to be journaled
+
+        Args:
+            data (dict): the request and response to journal
+            healthy (bool): False for unmatched requests, which are never sampled
+        """
+        if healthy and random.random() >= JOURNAL_SAMPLE_RATE:  # nosec
+            return
+        try:
+            self.queue.put_nowait({'epoch': time.time(), 'data': data})
+        except queue.Full:
+            self.dropped += 1
+            if not self.dropped % 1000:
+                LOG.info('request journal full, dropped %s requests', self.dropped)
+
+    def _open(self) -> None:
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
+        self._handler = open(self.filename, 'a', encoding='utf8')  # pylint: disable=consider-using-with
+        self.opened = time.time()
+
+    def _write(self, batch: list) -> None:
+        if self._handler is None:
+            self._open()
+        self._handler.write(
+            ''.join(json.dumps(line, default=str) + '\n' for line in batch)
+        )
+        self._handler.flush()
+        if self._handler.tell() >= JOURNAL_MAX_BYTES \
+                or time.time() - self.opened >= JOURNAL_MAX_AGE:
+            self.rotate()
+
+    def rotate(self) -> None:
+        """ I close the journal file, compress it and prune old journals
+        """
+        if self._handler is None:
+            return
+        self._handler.close()
+        self._handler = None
+        rotated = os.path.join(
+            self.path,
+            f"journal-{self.pid}-{time.strftime('%Y%m%d%H%M%S')}.jsonl"
+        )
+        os.replace(self.filename, rotated)
+        if JOURNAL_COMPRESS:
+            with open(rotated, 'rb') as source, gzip.open(f'{rotated}.gz', 'wb') as target:
+                shutil.copyfileobj(source, target)
+            os.remove(rotated)
+        self.prune()
+
+    def prune(self) -> None:
+        """ I remove the oldest rotated journals beyond BF2PICO_JOURNAL_KEEP
+        """
+        rotated = sorted(
+            glob.glob(os.path.join(self.path, 'journal-*-*.jsonl*')),
+            key=os.path.getmtime
+        )
+        for filename in rotated[:max(len(rotated) - JOURNAL_KEEP, 0)]:
+            LOG.debug('removing journal %s', filename)
+            os.remove(filename)
+
+    def _drain(self, timeout: float) -> list:
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=timeout))
+            while len(batch) < JOURNAL_QUEUE_SIZE:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _flush(self, batch: list) -> None:
+        if not batch:
+            return
+        try:
+            self._write(batch)
+        except OSError as err_msg:
+            LOG.error('unable to write request journal: %s', err_msg)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._flush(self._drain(JOURNAL_BATCH_SECONDS))
+        # only this thread touches the file, so the last writes are made here
+        batch = self._drain(0)
+        while batch:
+            self._flush(batch)
+            batch = self._drain(0)
+        if self._handler is not None:
+            self._handler.close()
+            self._handler = None
+
+    def close(self) -> None:
+        """ I stop the writer thread, which writes what is queued and closes
+            the journal
+        """
+        self._stop.set()
+        self._thread.join(timeout=JOURNAL_BATCH_SECONDS * 2)
+        if self._thread.is_alive():
+            LOG.info('request journal is still writing, not waiting for it')
+
+
+_JOURNAL = {}
+
+
+def get_journal() -> RequestJournal:
+    """ I return the journal of this process, starting it on first use so
+        each forked worker gets its own writer thread.
+
+    Returns:
+        RequestJournal: the journal
+    """
+    pid = os.getpid()
+    if pid not in _JOURNAL:
+        _JOURNAL.clear()
+        _JOURNAL[pid] = RequestJournal()
+        atexit.register(_JOURNAL[pid].close)
+    return _JOURNAL[pid]
@@ -3,17 +3,26 @@
 """
 
 
+import hashlib
 import json
+import os
 import random
 import string
+import time
+
+
+from concurrent.futures import ThreadPoolExecutor
 
 
 from bf2pico import (
     CACHE,
+    CACHE_TIME,
     LOG,
     PERSISTENT_CACHE_TIME,
     brewfather,
-    prosaic,
+    catalog,
+    prefetch,
+    recipemap,
 )
 
 
@@ -29,6 +38,12 @@ PICO_LOCATIONS = {
 }
 DRAINTIME = 8  # how long the zymatic should drain
 
+# seconds a recipe list is served before it is rebuilt in the background
+RECIPE_LIST_SOFT_TTL = int(os.getenv('BF2PICO_RECIPE_LIST_SOFT_TTL', '30'))
+
+# seconds a recipe list may be served before the zymatic waits for a rebuild
+RECIPE_LIST_HARD_TTL = int(os.getenv('BF2PICO_RECIPE_LIST_HARD_TTL', str(60 * 60 * 24)))  # 1 day
+
 
 
 def _gid() -> str:
@@ -252,184 +267,118 @@ def gen_pico(recipe: dict) -> dict:
     return pico
 
 
-def get_list_recipes_map(user_id: str) -> dict:
-    """_summary_
+def program_hash(recipe: dict) -> str:
+    """ I hash the parts of a brewfather recipe gen_pico reads, so recipes
+        which differ only in other fields share a compiled program.
 
     Args:
-        user_id (str): brewfather user id
+        recipe (dict): A recipe from brewfather in dict form.
 
     Returns:
-        dict: dict of the list_recipes
-            {
-                'by_pico_id': {
-                    170335: {
-                        name: name,
-                        batch_id: the_unique_batch_id,
-                        recipe_id: recipe_id
-                    }
-                }
-                'by_name': {
-                    name: {
-                        pico_id: pico_id,
-                        batch_id: the_unique_batch_id,
-                        recipe_id: recipe_id
-                    }
-                },
-                'by_batch_id': {
-                    batch_id: {
-                        name: name,
-                        pico_id: pico_id,
-                        recipe_id: recipe_id
-                    }
-                },
-                'by_recpie_id': {
-                    recipe_id: {
-                        name: name,
-                        pico_id: pico_id,
-                        batch_id: the_unique_batch_id
-                    }
-                }
-            }
+        str: the sha256 hex digest
     """
-    result_key = f'pico_recipe_map/{user_id}.json'
-    result = prosaic.s3_get(result_key, None)
-    if result:
-        return json.loads(result)
-    return \
-        {
-            'by_pico_id': {},
-            'by_name': {},
-            'by_batch_id': {},
-            'by_recipe_id': {},
-        }
+    source = {
+        '_id': recipe['_id'],
+        'name': recipe['name'],
+        'boilTime': recipe['boilTime'],
+        'mash': [
+            [step['stepTemp'], step['stepTime']]
+            for step in recipe['mash']['steps']
+        ],
+        'hops': [
+            [hop['use'], hop['time']]
+            for hop in recipe['hops']
+        ],
+        'chill': [
+            [record['amount'], record['time']]
+            for record in recipe.get('miscs', [])
+            if record['name'].lower() == 'chill'
+        ],
+    }
+    return hashlib.sha256(
+        json.dumps(source, sort_keys=True).encode('utf8')
+    ).hexdigest()
 
 
-def list_recipes_next_id(data: dict) -> int:
-    """ I return the next id to be used
+def compile_program(recipe: dict) -> dict:
+    """ I return the pico program of a brewfather recipe, compiling it only
+        if a recipe with the same content has not been compiled before.
 
     Args:
-        data (dict): dict of our pico_iud to batch ids.
+        recipe (dict): A recipe from brewfather in dict form.
 
     Returns:
-        int: next int to use
+        dict: A pico list of steps to brew the recipe.
     """
-    if not data:
-        return 170335
-    return int(max(list(data))) + 1
+    program_key = f'pico-program-{program_hash(recipe)}'
+    result = CACHE.get(program_key, None)
+    if result is None:
+        result = gen_pico(recipe)
+        CACHE.set(program_key, result, expire=PERSISTENT_CACHE_TIME)
+    return result
 
 
-def add_list_recipes(user_id: str, data: dict, recipe:dict) -> dict:
-    """ I add a new recipe to the list recipes map
+def cached_program(user_id: str, recipe_id: str) -> dict:
+    """ I return the compiled program of a recipe if it is cached and the
+        recipe has not changed in the catalog since.
 
     Args:
-        user_id (str): string of the brewfather user_id
-        data (dict): dict of the recipes_map
-            {
-                'by_pico_id': {
-                    170335: {
-                        name: name,
-                        batch_id: the_unique_batch_id,
-                        recipe_id: recipe_id
-                    }
-                }
-                'by_name': {
-                    name: {
-                        pico_id: pico_id,
-                        batch_id: the_unique_batch_id,
-                        recipe_id: recipe_id
-                    }
-                },
-                'by_batch_id': {
-                    batch_id: {
-                        name: name,
-                        pico_id: pico_id,
-                        recipe_id: recipe_id
-                    }
-                },
-                'by_recpie_id': {
-                    recipe_id: {
-                        name: name,
-                        pico_id: pico_id,
-                        batch_id: the_unique_batch_id
-                    }
-                }
-            }
-        recipe (dict): the recipe to add
-            {
-                "_id": "ydnH0UmnH45Zf40Cg9VvQQ3X4Nyo16",
-                "batchNo": 8,
-                "brewDate": 1676782800000,
-                "brewer": null,
-                "name": "Batch",
-                "recipe": {
-                    "name": "Heat to 110"
-                },
-                "status": "Planning"
-            }
+        user_id (str): brewfather user id
+        recipe_id (str): the brewfather recipe id
+
+    Returns:
+        dict: the pico program, None if it is not cached
+    """
+    pointer = CACHE.get(f'pico-recipe-{recipe_id}', None)
+    if not pointer:
+        return None
+    if pointer['stamp'] != catalog.get_catalog(user_id).stamp(recipe_id):
+        return None
+    return CACHE.get(f'pico-program-{pointer["hash"]}', None)
+
+
+def get_program(creds: object, recipe_id: str) -> dict:
+    """ I return the pico program of a recipe, from cache when the recipe
+        has not changed, else fetched from brewfather and compiled.
 
-    Returns (dict): recipe map
+    Args:
+        creds (object): the authentication objects for brewfather
+        recipe_id (str): the brewfather recipe id
+
+    Returns:
+        dict: the pico program
+    """
+    result = cached_program(creds.user_id, recipe_id)
+    if result is not None:
+        return result
+
+    stamp = catalog.get_catalog(creds.user_id).stamp(recipe_id)
+    brewfather.forget_recipe(recipe_id)
+    bf_recipe = brewfather.get_recipe(creds.auth(), recipe_id)
+    result = compile_program(bf_recipe)
+    CACHE.set(
+        f'pico-recipe-{recipe_id}',
         {
-            'by_pico_id': {
-                170335: {
-                    name: name,
-                    batch_id: the_unique_batch_id,
-                    recipe_id: recipe_id
-                }
-            }
-            'by_name': {
-                name: {
-                    pico_id: pico_id,
-                    batch_id: the_unique_batch_id,
-                    recipe_id: recipe_id
-                }
-            },
-            'by_batch_id': {
-                batch_id: {
-                    name: name,
-                    pico_id: pico_id,
-                    recipe_id: recipe_id
-                }
-            },
-            'by_recpie_id': {
-                recipe_id: {
-                    name: name,
-                    pico_id: pico_id,
-                    batch_id: the_unique_batch_id
-                }
-            }
-        }
+            'stamp': stamp,
+            'hash': program_hash(bf_recipe),
+        },
+        # without a catalog stamp the change can not be seen, so trust it briefly
+        expire=PERSISTENT_CACHE_TIME if stamp is not None else CACHE_TIME
+    )
+    return result
+
+
+def forget_program(recipe_id: str) -> None:
+    """ I drop the compiled program of a recipe which changed
+
+    Args:
+        recipe_id (str): the brewfather recipe id
     """
-    pico_id = list_recipes_next_id(data['by_pico_id'])
-    batch_id = recipe['_id']
-    name = recipe['recipe']['name']
-    recipe_id = recipe['recipe_id']
-    data['by_pico_id'][pico_id] = {
-        'name': name,
-        'batch_id': batch_id,
-        'recipe_id': recipe_id,
-    }
-    data['by_name'][name] = {
-        'pico_id': pico_id,
-        'batch_id': batch_id,
-        'recipe_id': recipe_id,
-    }
-    data['by_batch_id'][batch_id] = {
-        'name': name,
-        'pico_id': pico_id,
-        'recipe_id': recipe_id
-    }
-    data['by_recipe_id'][recipe_id] = {
-        'name': name,
-        'pico_id': pico_id,
-        'batch_id': batch_id,
-    }
-    result_key = f'pico_recipe_map/{user_id}.json'
-    prosaic.s3_put(json.dumps(data), result_key)
-    return data
+    CACHE.delete(f'pico-recipe-{recipe_id}')
 
 
-def list_recipes(creds: object) -> list:
-    """ returns a list of pico recipes
+def build_recipe_list(creds: object) -> list:
+    """ returns a list of pico recipes, built from brewfather
 
     Args:
         auth (BrewAuth): BrewAuth object for managing authentication
@@ -447,22 +396,30 @@ def list_recipes(creds: object) -> list:
                     }
                 ]
     """
-    recipes = brewfather.get_recipes(creds.auth())
-    planning = brewfather.get_batchs(creds.auth(), 'Planning')
+    recipes = catalog.get_catalog(creds.user_id)
+    # the catalog sync and the batches call do not depend on each other
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        synced = pool.submit(recipes.refresh, creds.auth())
+        planning = pool.submit(brewfather.get_batchs, creds.auth(), 'Planning')
+        synced.result()
+        planning = planning.result()
     LOG.debug('planning')
     LOG.debug(json.dumps(planning, indent=2))
-    result = []
-    recipe_map = get_list_recipes_map(creds.user_id)
-    LOG.debug('recipe_map')
-    LOG.debug(json.dumps(recipe_map, indent=2))
+    recipe_map = recipemap.get_recipe_map(creds.user_id)
     for recipe in planning:
         recipe_name = recipe['recipe']['name']
-        recipe['recipe_id'] = recipes[recipe_name]['_id']
-        if recipe['_id'] not in recipe_map['by_batch_id']:
-            recipe_map = add_list_recipes(creds.user_id, recipe_map, recipe)
+        if recipes.recipe_id(recipe_name) is None:
+            # a recipe newer than the catalog
+            recipes.sync(creds.auth())
+        recipe_map.add(recipe['_id'], recipe_name, recipes.names[recipe_name])
+    # the new batches get their pico ids in one write
+    recipe_map.save()
+
+    result = []
+    for recipe in planning:
         result.append(
             {
-                'ID': recipe_map['by_batch_id'][recipe['_id']]['pico_id'],
+                'ID': recipe_map.by_batch(recipe['_id'])['pico_id'],
                 'Name': recipe['recipe']['name'],
                 'Kind': 0,
                 'Uri': None,
@@ -483,9 +440,11 @@ def get_recipe(creds: object, pico_id: str) -> dict:
     Returns:
         dict: Pico formated brew steps.
     """
-    recipe_map = get_list_recipes_map(creds.user_id)
-    batch_id = recipe_map['by_pico_id'][str(pico_id)]['batch_id']
-    bf_recipe = brewfather.get_recipe_from_batch_id(creds, batch_id)
+    recipe_id = recipemap.get_recipe_map(creds.user_id)[pico_id]['recipe_id']
+    result = cached_program(creds.user_id, recipe_id)
+    prefetch.used(recipe_id, result is not None)
+    if result is None:
+        result = get_program(creds, recipe_id)
 
     CACHE.set(
         f'{creds.device_id}-recipe',
@@ -493,7 +452,6 @@ def get_recipe(creds: object, pico_id: str) -> dict:
         expire=PERSISTENT_CACHE_TIME
     )
 
-    result = gen_pico(bf_recipe)
     result['ID'] = pico_id
     return result
 
@@ -508,11 +466,93 @@ def change_batch_state(creds: object, pico_id: str, status: str) -> None:
     """
 
     # Move from planning to brewing
-    session_map = get_list_recipes_map(creds.user_id)
-    LOG.debug('session_map')
-    LOG.debug(json.dumps(session_map, indent=2))
     try:
-        batch_id = session_map['by_pico_id'][str(pico_id)]['batch_id']
+        batch_id = recipemap.get_recipe_map(creds.user_id)[pico_id]['batch_id']
         brewfather.change_batch_status(creds, batch_id, status)
     except:  # pylint: disable=bare-except
         LOG.debug('Unable to link to brewfather most likely a rinse.  pico_id=%s')
+
+
+_EXECUTOR = {}
+
+
+def _executor() -> ThreadPoolExecutor:
+    pid = os.getpid()
+    if pid not in _EXECUTOR:
+        _EXECUTOR.clear()
+        _EXECUTOR[pid] = ThreadPoolExecutor(
+            max_workers=2,
+            thread_name_prefix='bf2pico-recipe-list'
+        )
+    return _EXECUTOR[pid]
+
+
+def refresh_recipe_list(creds: object) -> list:
+    """ I build the recipe list of a user and keep it as the last known good
+
+    Args:
+        creds (object): BrewAuth object for managing authentication
+
+    Returns:
+        list: Pico format list of recipes
+    """
+    result = build_recipe_list(creds)
+    CACHE.set(
+        f'recipe-list-{creds.user_id}',
+        {
+            'built': time.time(),
+            'recipes': result,
+        }
+    )
+    return result
+
+
+def _refresh_in_background(creds: object) -> None:
+    guard = f'recipe-list-refresh-{creds.user_id}'
+    if not CACHE.add(guard, os.getpid(), expire=RECIPE_LIST_SOFT_TTL):
+        return
+
+    def run() -> None:
+        try:
+            refresh_recipe_list(creds)
+        except Exception as err_msg:  # pylint: disable=broad-exception-caught
+            LOG.info('refreshing the recipe list of %s failed: %s', creds.user_id, err_msg)
+        finally:
+            CACHE.delete(guard)
+
+    _executor().submit(run)
+
+
+def list_recipes(creds: object) -> list:
+    """ returns a list of pico recipes, stale while revalidate
+
+    The last known list is returned at once and rebuilt in the background
+    once it is older than RECIPE_LIST_SOFT_TTL. Only a list older than
+    RECIPE_LIST_HARD_TTL, or none at all, is rebuilt while the zymatic
+    waits, and if brewfather fails then the last known list is returned.
+
+    Args:
+        creds (BrewAuth): BrewAuth object for managing authentication
+
+    Returns:
+        list: Pico format list of recipes, see build_recipe_list
+    """
+    cached = CACHE.get(f'recipe-list-{creds.user_id}', None)
+    age = time.time() - cached['built'] if cached else None
+    if cached and age < RECIPE_LIST_HARD_TTL:
+        if age >= RECIPE_LIST_SOFT_TTL:
+            _refresh_in_background(creds)
+        return cached['recipes']
+
+    try:
+        return refresh_recipe_list(creds)
+    except Exception as err_msg:  # pylint: disable=broad-exception-caught
+        if not cached:
+            raise
+        LOG.info(
+            'unable to rebuild the recipe list of %s, serving one %ss old: %s',
+            creds.user_id,
+            int(age),
+            err_msg
+        )
+        return cached['recipes']
@@ -0,0 +1,161 @@
+"""
+    I prefetch and compile the planned recipes of a user in the background.
+
+    A zymatic which lists its recipes, or checks in with ZState, will most
+    likely fetch one of the planned recipes next. The programs of every
+    planned batch are compiled on a bounded thread pool so the following
+    get_recipe is served from the cache.
+
+    The counters are kept in the shared cache so they cover every worker:
+        prefetch-scheduled: prefetch jobs run
+        prefetch-dropped: jobs dropped because the pool was full
+        prefetch-compiled: programs fetched and compiled by a prefetch
+        prefetch-cached: programs a prefetch found already compiled
+        prefetch-hits: recipe fetches served by a prefetched program
+        prefetch-misses: recipe fetches which had to call brewfather
+"""
+
+
+import os
+import threading
+import time
+
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+from bf2pico import (
+    CACHE,
+    EPHEMERAL_CACHE_TIME,
+    LOG,
+    brewfather,
+    catalog,
+    pico,
+)
+
+
+PREFETCH_WORKERS = int(os.getenv('BF2PICO_PREFETCH_WORKERS', '4'))
+
+# how many prefetch jobs may wait for a worker
+PREFETCH_QUEUE = int(os.getenv('BF2PICO_PREFETCH_QUEUE', '32'))
+
+# seconds between prefetches for the same user
+PREFETCH_INTERVAL = int(os.getenv('BF2PICO_PREFETCH_INTERVAL', '60'))
+
+COUNTERS = [
+    'prefetch-scheduled',
+    'prefetch-dropped',
+    'prefetch-compiled',
+    'prefetch-cached',
+    'prefetch-hits',
+    'prefetch-misses',
+]
+
+_EXECUTOR = {}
+
+_PENDING = threading.BoundedSemaphore(PREFETCH_QUEUE + PREFETCH_WORKERS)
+
+
+def _executor() -> ThreadPoolExecutor:
+    pid = os.getpid()
+    if pid not in _EXECUTOR:
+        _EXECUTOR.clear()
+        _EXECUTOR[pid] = ThreadPoolExecutor(
+            max_workers=PREFETCH_WORKERS,
+            thread_name_prefix='bf2pico-prefetch'
+        )
+    return _EXECUTOR[pid]
+
+
+def _count(name: str) -> None:
+    CACHE.incr(name, default=0)
+
+
+def prefetch_planned(creds: object) -> int:
+    """ I fetch and compile the programs of the planned batches of a user
+
+    Args:
+        creds (object): the authentication objects for brewfather
+
+    Returns:
+        int: how many programs were compiled
+    """
+    auth = creds.auth()
+    recipes = catalog.get_catalog(creds.user_id)
+    recipes.refresh(auth)
+    compiled = 0
+    for batch in brewfather.get_batchs(auth, 'Planning'):
+        recipe_id = recipes.recipe_id(batch['recipe']['name'])
+        if recipe_id is None:
+            continue
+        if pico.cached_program(creds.user_id, recipe_id) is not None:
+            _count('prefetch-cached')
+            continue
+        pico.get_program(creds, recipe_id)
+        CACHE.set(f'prefetched-{recipe_id}', time.time(), expire=EPHEMERAL_CACHE_TIME)
+        _count('prefetch-compiled')
+        compiled += 1
+    LOG.debug('prefetched %s programs for %s', compiled, creds.user_id)
+    return compiled
+
+
+def schedule(creds: object=None, device_id: str='') -> bool:
+    """ I queue a prefetch for a user, at most once per PREFETCH_INTERVAL
+        across the workers of this host.
+
+    Args:
+        creds (object): the authentication objects for brewfather
+        device_id (str): the zymatic token, used when creds is not given
+
+    Returns:
+        bool: True if a prefetch was queued
+    """
+    user_key = creds.user_id if creds is not None else device_id
+    if not CACHE.add(f'prefetch-{user_key}', time.time(), expire=PREFETCH_INTERVAL):
+        return False
+    if not _PENDING.acquire(blocking=False):  # pylint: disable=consider-using-with
+        _count('prefetch-dropped')
+        CACHE.delete(f'prefetch-{user_key}')
+        return False
+
+    def run() -> None:
+        try:
+            _count('prefetch-scheduled')
+            prefetch_planned(
+                creds if creds is not None else brewfather.BrewAuth(device_id=device_id)
+            )
+        except Exception as err_msg:  # pylint: disable=broad-exception-caught
+            LOG.info('prefetch for %s failed: %s', user_key, err_msg)
+        finally:
+            _PENDING.release()
+
+    _executor().submit(run)
+    return True
+
+
+def used(recipe_id: str, hit: bool) -> None:
+    """ I count a recipe fetch by a zymatic against the prefetches
+
+    Args:
+        recipe_id (str): the brewfather recipe id
+        hit (bool): True if the program was served from the cache
+    """
+    prefetched = CACHE.pop(f'prefetched-{recipe_id}', None)
+    if hit and prefetched is not None:
+        _count('prefetch-hits')
+    elif not hit:
+        _count('prefetch-misses')
+
+
+def stats() -> dict:
+    """ I return the prefetch counters, with the hit rate and the waste
+
+    Returns:
+        dict: the counters, hit_rate of recipe fetches served by a prefetch
+            and wasted programs compiled by a prefetch and not fetched (yet)
+    """
+    result = {name: CACHE.get(name, 0) for name in COUNTERS}
+    fetches = result['prefetch-hits'] + result['prefetch-misses']
+    result['hit_rate'] = result['prefetch-hits'] / fetches if fetches else 0.0
+    result['wasted'] = max(result['prefetch-compiled'] - result['prefetch-hits'], 0)
+    return result
@@ -3,8 +3,11 @@
 """
 
 
+import gzip
 import json
 import logging
+import mimetypes
+import time
 
 
 from email.mime.image import MIMEImage
@@ -12,19 +15,20 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
 
-import boto3
-
-
-from botocore.exceptions import ClientError
+import diskcache
 
 
 from bf2pico import (
-    BUCKET,
     CACHE,
+    CACHE_FRESHNESS,
+    COMPRESS_LEVEL,
+    HOT_CACHE,
     LOG,
     PERSISTENT_CACHE_TIME,
-    SSM,
     get_parameter,
+    get_ssm,
+    singleflight,
+    storage,
 )
 
 
@@ -33,7 +37,10 @@ logging.getLogger('botocore').setLevel(logging.CRITICAL)
 logging.getLogger('s3transfer').setLevel(logging.CRITICAL)
 
 
-S3 = boto3.client('s3')
+# bodies smaller than this are not worth the gzip header
+COMPRESS_MIN_SIZE = 128
+
+GZIP_MAGIC = b'\x1f\x8b'
 
 
 def delete_parameter(name: str) -> None:
@@ -42,12 +49,12 @@ def delete_parameter(name: str) -> None:
     Args:
         name (str): parameter name
     """
-    response = SSM.delete_parameter(Name=name)
+    response = get_ssm().delete_parameter(Name=name)
     LOG.debug(json.dumps(response, default=str))
     for param in list(CACHE):
         if param.startswith('parameters-'):
             LOG.debug('Clearing Parameter')
-            CACHE.pop(param)
+            HOT_CACHE.pop(param)
 
 
 def put_parameter(name: str, value: str) -> None:
@@ -57,7 +64,7 @@ def put_parameter(name: str, value: str) -> None:
         name (str): parameter name
         value (str): parameter value
     """
-    response = SSM.put_parameter(
+    response = get_ssm().put_parameter(
         Name=name,
         Description=f'for {name}',
         Value=value,
@@ -70,7 +77,7 @@ def put_parameter(name: str, value: str) -> None:
     for param in list(CACHE):
         if param.startswith('parameters-'):
             LOG.debug('Clearing Parameter %s', param)
-            CACHE.pop(param)
+            HOT_CACHE.pop(param)
 
 
 def get_parameters(path: str) -> dict:
@@ -82,10 +89,11 @@ def get_parameters(path: str) -> dict:
                 parameter name: parameter value
             }
     """
-    if CACHE.get(f'parameters-{path}', None):
-        return json.loads(CACHE.get(f'parameters-{path}'))
+    cached = HOT_CACHE.get(f'parameters-{path}', None, decode=json.loads)
+    if cached:
+        return dict(cached)
     result = {}
-    response = SSM.get_parameters_by_path(
+    response = get_ssm().get_parameters_by_path(
         Path=path,
         Recursive=True,
         WithDecryption=True
@@ -93,7 +101,7 @@ def get_parameters(path: str) -> dict:
     for param in response['Parameters']:
         result[param['Name'].split('/')[-1]] = param['Value']
     if response.get('NextToken',  None):
-        response = SSM.get_parameters_by_path(
+        response = get_ssm().get_parameters_by_path(
             Path=path,
             Recursive=True,
             WithDecryption=True,
@@ -101,10 +109,11 @@ def get_parameters(path: str) -> dict:
         )
         for param in response['Parameters']:
             result[param['Name'].split('/')[-1]] = param['Value']
-    CACHE.set(
+    HOT_CACHE.set(
         f'parameters-{path}',
         json.dumps(result),
-        expire=PERSISTENT_CACHE_TIME
+        expire=PERSISTENT_CACHE_TIME,
+        hot_value=dict(result)
     )
     return result
 
@@ -118,72 +127,280 @@ def s3_getobjects(path: str) -> list:
     Returns:
         list: list of objects in a bucket path
     """
-    result = []
-    LOG.debug('Looking for object in s3://%s/%s', BUCKET, path)
-    response = S3.list_objects_v2(
-        Bucket=BUCKET,
-        Prefix=path,
-        FetchOwner=False,
+    backend = storage.get_storage()
+    LOG.debug('Looking for object in %s', backend.describe(path))
+    return backend.list(path)
+
+
+def _encode(data) -> tuple:
+    """ I return the body to store for an object and its content encoding
+
+    Args:
+        data: the contexts of the object, str or bytes.
+
+    Returns:
+        tuple: (body as bytes, 'gzip' or None)
+    """
+    body = data.encode('utf8') if isinstance(data, str) else data
+    if COMPRESS_LEVEL and len(body) >= COMPRESS_MIN_SIZE:
+        # mtime=0 so the same data always has the same body
+        return gzip.compress(body, compresslevel=COMPRESS_LEVEL, mtime=0), 'gzip'
+    return body, None
+
+
+def _decode(body: bytes) -> bytes:
+    """ I return the contexts of a stored body, uncompressing it if needed
+
+    Args:
+        body (bytes): the stored body
+
+    Returns:
+        bytes: the contexts of the object
+    """
+    if isinstance(body, str):
+        return body.encode('utf8')
+    if body[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        return gzip.decompress(body)
+    return body
+
+
+def s3_exists(key: str) -> bool:
+    """
+        I return if an object exists, with a HEAD rather than a listing.
+
+        Args:
+            key (str): the object key to check
+
+        Returns:
+            bool: True if the object exists
+    """
+    if f's3-{key}' in HOT_CACHE:
+        return True
+    backend = storage.get_storage()
+    LOG.debug('checking %s', backend.describe(key))
+    return backend.exists(key)
+
+
+def _cache_entry(key: str) -> dict:
+    """ I return the cached copy of an object
+
+    Args:
+        key (str): the object key
+
+    Returns:
+        dict: {'body': stored body, 'etag': etag, 'checked': epoch} or None
+    """
+    return HOT_CACHE.get(f's3-{key}', None, decode=_decoded_entry)
+
+
+def _shared_entry(key: str) -> dict:
+    """ I return the copy of an object shared by the workers of this host,
+        never the in process LRU which may be older than their writes
+
+    Args:
+        key (str): the object key
+
+    Returns:
+        dict: {'body': stored body, 'etag': etag, 'checked': epoch} or None
+    """
+    entry = HOT_CACHE.get_shared(f's3-{key}', None)
+    return entry if isinstance(entry, dict) else None
+
+
+def _decoded_entry(entry) -> dict:
+    """ I add the uncompressed contexts to a cache entry for the LRU
+
+    Args:
+        entry: the diskcache value of an object
+
+    Returns:
+        dict: {'body': stored body, 'etag': etag, 'checked': epoch, 'data': contexts}
+    """
+    if not isinstance(entry, dict):
+        # cached before etags were kept, revalidate on next read
+        body = entry.encode('utf8') if isinstance(entry, str) else entry
+        entry = {'body': body, 'etag': storage.etag(body), 'checked': 0}
+    return dict(entry, data=_decode(entry['body']))
+
+
+def _cache_store(key: str, body: bytes, etag: str) -> None:
+    """ I cache the stored body of an object with its etag
+
+    Args:
+        key (str): the object key
+        body (bytes): the stored body
+        etag (str): the etag of the stored body
+    """
+    entry = {
+        'body': body,
+        'etag': etag,
+        'checked': time.time(),
+    }
+    HOT_CACHE.set(
+        f's3-{key}',
+        entry,
+        expire=PERSISTENT_CACHE_TIME,
+        hot_value=dict(entry, data=_decode(body))
     )
-    for record in response.get('Contents', []):
-        result.append(record['Key'])
-    while response.get('NextContinuationToken', None):
-        response = S3.list_objects_v2(
-            Bucket=BUCKET,
-            NextContinuationToken=response['NextContinuationToken']
-        )
-        for record in response.get('Contents', []):
-            result.append(record['Key'])
-    return result
 
 
 def s3_put(data, key) -> None:
     """
         I write to the bucket the job data.
 
+        The data is gzip compressed, with the Content-Encoding set so the
+        website still serves it as is.
+
         Args:
-            data: the contexts to write in the object.
+            data: the contexts to write in the object, str or bytes.
             key: the object key to write.
     """
-    cache_key = f's3-{key}'
-    cache_value = CACHE.get(cache_key, '')
-    if cache_value and  cache_value == data:
+    body, encoding = _encode(data)
+    entry = _shared_entry(key)
+    if entry and entry['body'] == body \
+            and time.time() - entry['checked'] < CACHE_FRESHNESS:
         LOG.debug('skipping s3 as the value is the same')
     else:
-        LOG.info('uploading s3://%s/%s', BUCKET, key)
-        result = S3.put_object(
-            Bucket=BUCKET,
-            Key=key,
-            Body=data,
-            ACL='bucket-owner-full-control'
+        backend = storage.get_storage()
+        LOG.info('uploading %s', backend.describe(key))
+        etag = backend.put(
+            key,
+            body,
+            content_type=mimetypes.guess_type(key)[0] or 'application/octet-stream',
+            content_encoding=encoding
         )
-        CACHE.set(cache_key, data, expire=PERSISTENT_CACHE_TIME)
-        LOG.debug(json.dumps(result, default=str))
+        _cache_store(key, body, etag)
 
 
-def s3_get(key: str, default=None) -> str:
+def s3_get_bytes(key: str, default=None, fresh: bool=False) -> bytes:
+    """
+        I return the contexts of a s3 object as bytes.
+
+        A cached copy is served for BF2PICO_CACHE_FRESHNESS seconds, after
+        that it is revalidated with its etag so an unchanged object is not
+        downloaded again.
+
+        Args:
+            key (str): the key to for the object to fetch
+            default (type): What to use as the default if key doesn't exist.
+            fresh (bool): revalidate a cached copy even if it is fresh
+
+        Returns:
+            bytes: the contexts of the object
+    """
+    def lookup():
+        entry = _cache_entry(key)
+        if not fresh and entry and time.time() - entry['checked'] < CACHE_FRESHNESS:
+            return entry['data']
+        return singleflight.MISSING
+
+    result = singleflight.do(
+        singleflight.flight_key('s3_get', key),
+        lookup,
+        lambda: _fetch(key)
+    )
+    return default if result is None else result
+
+
+def _fetch(key: str) -> bytes:
+    """
+        I revalidate the cached copy of an object or fetch it.
+
+        Args:
+            key (str): the key to for the object to fetch
+
+        Returns:
+            bytes: the contexts of the object, None if it doesn't exist
+    """
+    backend = storage.get_storage()
+    entry = _cache_entry(key)
+    if entry:
+        LOG.debug('revalidating %s', backend.describe(key))
+        body, etag = backend.revalidate(key, entry['etag'])
+        if body is None and etag is not None:
+            _cache_store(key, entry['body'], etag)
+            return entry['data']
+    else:
+        LOG.debug('fetching %s', backend.describe(key))
+        body, etag = backend.get_versioned(key)
+
+    if body is None:
+        HOT_CACHE.delete(f's3-{key}')
+        return None
+    _cache_store(key, body, etag)
+    return _decode(body)
+
+
+def s3_get(key: str, default=None, fresh: bool=False) -> str:
     """
         I return the contexts of a s3 object.
 
         Args:
             key (str): the key to for the object to fetch
             default (type): What to use as the default if key doesn't exist.
+            fresh (bool): revalidate a cached copy even if it is fresh
 
         Returns:
             the contexts of the object
     """
-    LOG.debug('fetching s3://%s/%s', BUCKET, key)
-    if f's3-{key}' in CACHE:
-        return CACHE.get(f's3-{key}')
-    try:
-        obj = S3.get_object(Bucket=BUCKET, Key=key)
-        result = obj['Body'].read().decode('utf8')
-        CACHE.set(f's3-{key}', result, expire=PERSISTENT_CACHE_TIME)
-        return result
-    except ClientError as err_msg:
-        if err_msg.response['Error']['Code'] == 'NoSuchKey':
-            return default
-        raise
+    result = s3_get_bytes(key, None, fresh=fresh)
+    if result is None:
+        return default
+    return result.decode('utf8')
+
+
+def s3_update(key: str, func, default: str='', attempts: int=10) -> str:
+    """
+        I atomically read, change and write an object.
+
+        Workers on this host take turns through a cache lock and other hosts
+        are caught by a conditional put on the etag, retrying on a conflict.
+
+        Args:
+            key (str): the object key to update
+            func: called with the current contexts (or default) and returns
+                the new contexts
+            default (str): the contexts to pass func when the object is missing
+            attempts (int): how many times to retry on a conflict
+
+        Returns:
+            str: the new contexts of the object
+    """
+    backend = storage.get_storage()
+    with diskcache.Lock(CACHE, f'lock-{key}', expire=60):
+        for _ in range(attempts):
+            body, etag = backend.get_versioned(key)
+            current = default if body is None else _decode(body).decode('utf8')
+            result = func(current)
+            new_body, encoding = _encode(result)
+            try:
+                etag = backend.put(
+                    key,
+                    new_body,
+                    content_type=mimetypes.guess_type(key)[0] or 'application/octet-stream',
+                    content_encoding=encoding,
+                    if_match=etag or '',
+                    if_none_match=etag is None
+                )
+            except storage.PreconditionFailed:
+                LOG.info('%s changed while updating, retrying', backend.describe(key))
+                continue
+            _cache_store(key, new_body, etag)
+            return result
+    raise Exception(f'Unable to update {key}')  # pylint: disable=broad-exception-raised
+
+
+def s3_upload_file(filename: str, key: str) -> None:
+    """
+        I upload a local file, such as a graph, to the bucket.
+
+        Args:
+            filename (str): the local file to upload
+            key (str): the object key to write
+    """
+    backend = storage.get_storage()
+    LOG.info('uploading %s to %s', filename, backend.describe(key))
+    backend.upload_file(filename, key)
 
 
 def email(
@@ -200,6 +417,7 @@ def email(
         mail_body (str, optional): The text mail body
         image_file (str, optional): The local file to send. Defaults to ''
     """
+    import boto3  # pylint: disable=import-outside-toplevel
     client = boto3.client('ses', region_name='us-east-2')
     msg = MIMEMultipart()
     msg['From'] = get_parameter('mailfrom')
@@ -209,7 +427,11 @@ def email(
 
     if image_file:
         with open(image_file, 'rb') as image_handler:
-            img = MIMEImage(image_handler.read())
+            # the svg subtype can not be guessed from the content
+            img = MIMEImage(
+                image_handler.read(),
+                _subtype=(mimetypes.guess_type(image_file)[0] or 'image/png').split('/')[1]
+            )
         msg.attach(img)
 
     if mail_body:
@@ -12,7 +12,11 @@ import logging
 import os
 
 
-from bf2pico import BrewFather, CACHE
+from bf2pico import (
+    CACHE,
+    brewfather,
+    pico,
+)
 
 
 LOG = logging.getLogger()
@@ -58,16 +62,16 @@ def _main() -> None:
     if args.purge:
         CACHE.clear()
 
-    bf_hander = BrewFather(
-        userid=args.userid,
-        apikey=args.apikey
-    )
-    recipes_list = bf_hander.start_session()
+    credentials = {'user_id': args.userid}
+    if args.apikey:
+        credentials['api_key'] = args.apikey
+    creds = brewfather.BrewAuth(**credentials)
+    recipes_list = {'Recipes': pico.build_recipe_list(creds)}
     if args.recipe:
         pico_recipe = ''
         for recipe in recipes_list['Recipes']:
             if recipe['Name'] == args.recipe:
-                pico_recipe = bf_hander.get_recipe(recipe['ID'])
+                pico_recipe = pico.get_recipe(creds, recipe['ID'])
                 print(
                     json.dumps(
                         pico_recipe,
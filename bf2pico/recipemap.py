@@ -0,0 +1,410 @@
+"""
+    I provide the map of pico recipe ids to brewfather batches of a user.
+
+    The map is stored in pico_recipe_map/{user_id}.json as one table keyed
+    by pico id, with the next pico id to hand out:
+        {
+            'next_id': 170336,
+            'recipes': {
+                '170335': {
+                    'name': name,
+                    'batch_id': the_unique_batch_id,
+                    'recipe_id': recipe_id
+                }
+            }
+        }
+    The indexes by batch, recipe and name are built in memory on load. New
+    batches are added in memory and written together by save, which hands
+    out their pico ids from the stored counter.
+
+    compact moves the batches which are no longer planned or brewing to the
+    cold pico_recipe_map_archive/{user_id}.json, which is only read when a
+    lookup misses the map. The archive and the lookups found nowhere are
+    kept for CACHE_TIME, so the routine pico id 0 costs no storage read.
+"""
+
+
+import json
+import os
+import threading
+import time
+
+
+from bf2pico import (
+    CACHE,
+    CACHE_TIME,
+    LOG,
+    brewfather,
+    prosaic,
+)
+
+
+FIRST_PICO_ID = 170335
+
+# seconds between compactions of the maps of a user
+COMPACT_INTERVAL = int(os.getenv('BF2PICO_COMPACT_INTERVAL', str(60 * 60 * 24)))  # 1 day
+
+# the batches which stay in the maps, the rest are archived
+ACTIVE_STATUSES = ['Planning', 'Brewing']
+
+
+def _empty() -> dict:
+    return {
+        'next_id': FIRST_PICO_ID,
+        'recipes': {},
+    }
+
+
+def _indexes(recipes: dict) -> tuple:
+    batches = {}
+    recipe_ids = {}
+    names = {}
+    for pico_id, entry in recipes.items():
+        batches[entry['batch_id']] = pico_id
+        recipe_ids[entry['recipe_id']] = pico_id
+        names[entry['name']] = pico_id
+    return batches, recipe_ids, names
+
+
+def _convert(data: dict) -> dict:
+    """ I convert a map stored with the four indexes to the table layout
+
+    Args:
+        data (dict): the stored map
+
+    Returns:
+        dict: the map as a table with its next_id
+    """
+    if 'by_pico_id' not in data:
+        return data
+    recipes = {
+        str(pico_id): {
+            'name': entry['name'],
+            'batch_id': entry['batch_id'],
+            'recipe_id': entry['recipe_id'],
+        }
+        for pico_id, entry in data['by_pico_id'].items()
+    }
+    return {
+        'next_id': max([int(pico_id) + 1 for pico_id in recipes] + [FIRST_PICO_ID]),
+        'recipes': recipes,
+    }
+
+
+class RecipeMap:
+    """
+        I am the pico ids of the brewfather batches of a user.
+
+        Args:
+            user_id (str): the brewfather user_id
+    """
+    def __init__(self, user_id: str) -> object:
+        self.user_id = user_id
+        self.key = f'pico_recipe_map/{user_id}.json'
+        self.archive_key = f'pico_recipe_map_archive/{user_id}.json'
+        self.data = _empty()
+        self.batches = {}
+        self.recipe_ids = {}
+        self.names = {}
+        self.loaded = 0
+        self._pending = {}
+        # (when it was read, its recipes and indexes)
+        self._archive = (0, {})
+        # (index, value): when it was found nowhere
+        self._misses = {}
+        self._lock = threading.RLock()
+        self.load()
+
+    def _index(self, data: dict) -> None:
+        indexes = _indexes(data['recipes'])
+        with self._lock:
+            self.data = data
+            self.batches, self.recipe_ids, self.names = indexes
+
+    def load(self, fresh: bool=False) -> None:
+        """ I read the map from storage
+
+        Args:
+            fresh (bool): revalidate the stored map even if the cached copy is fresh
+        """
+        stored = prosaic.s3_get(self.key, '', fresh=fresh)
+        self._index(_convert(json.loads(stored)) if stored else _empty())
+        self.loaded = time.time()
+
+    def _entry(self, pico_id: str) -> dict:
+        entry = self.data['recipes'].get(pico_id, None)
+        if entry is None:
+            return None
+        return dict(entry, pico_id=int(pico_id))
+
+    def _archived_indexes(self) -> dict:
+        """ I return the recipes and indexes of the archive, read at most
+            once per CACHE_TIME and outside the lock
+
+        Returns:
+            dict: 'recipes' and the batches, recipe_ids, names and pico_ids indexes
+        """
+        with self._lock:
+            loaded, result = self._archive
+        if time.time() - loaded <= CACHE_TIME:
+            return result
+        stored = prosaic.s3_get(self.archive_key, '', fresh=True)
+        recipes = json.loads(stored)['recipes'] if stored else {}
+        batches, recipe_ids, names = _indexes(recipes)
+        result = {
+            'recipes': recipes,
+            'batches': batches,
+            'recipe_ids': recipe_ids,
+            'names': names,
+            'pico_ids': {pico_id: pico_id for pico_id in recipes},
+        }
+        with self._lock:
+            self._archive = (time.time(), result)
+        return result
+
+    def archived(self, index: str, value: str) -> dict:
+        """ I look up a recipe in the archive of compacted batches
+
+        Args:
+            index (str): batches, recipe_ids, names or pico_ids
+            value (str): the value to look up
+
+        Returns:
+            dict: {'pico_id', 'name', 'batch_id', 'recipe_id'}, None if it is not archived
+        """
+        archive = self._archived_indexes()
+        pico_id = archive[index].get(value, None)
+        if pico_id is None:
+            return None
+        LOG.debug('found %s in the archive of %s', value, self.user_id)
+        return dict(archive['recipes'][pico_id], pico_id=int(pico_id))
+
+    def _find(self, index: str, value: str) -> str:
+        if index == 'pico_ids':
+            return value if value in self.data['recipes'] else None
+        return getattr(self, index).get(value, None)
+
+    def _lookup(self, index: str, value: str) -> dict:
+        pico_id = self._find(index, value)
+        if pico_id is not None:
+            return self._entry(pico_id)
+        with self._lock:
+            missed = self._misses.get((index, value), 0)
+        if time.time() - missed <= CACHE_TIME:
+            return None
+        # added by another worker since the map was loaded
+        self.load(fresh=True)
+        pico_id = self._find(index, value)
+        if pico_id is not None:
+            return self._entry(pico_id)
+        result = self.archived(index, value)
+        if result is None:
+            with self._lock:
+                self._misses[(index, value)] = time.time()
+        return result
+
+    def get(self, pico_id) -> dict:
+        """ I return a recipe by pico id
+
+        Args:
+            pico_id: the pico id, int or str
+
+        Returns:
+            dict: {'pico_id', 'name', 'batch_id', 'recipe_id'}, None if it is not mapped
+        """
+        return self._lookup('pico_ids', str(pico_id))
+
+    def __getitem__(self, pico_id) -> dict:
+        result = self.get(pico_id)
+        if result is None:
+            raise KeyError(pico_id)
+        return result
+
+    def by_batch(self, batch_id: str) -> dict:
+        """ I return a recipe by brewfather batch id
+
+        Args:
+            batch_id (str): the brewfather batch id
+
+        Returns:
+            dict: {'pico_id', 'name', 'batch_id', 'recipe_id'}, None if it is not mapped
+        """
+        return self._lookup('batches', batch_id)
+
+    def by_recipe(self, recipe_id: str) -> dict:
+        """ I return the latest batch of a brewfather recipe
+
+        Args:
+            recipe_id (str): the brewfather recipe id
+
+        Returns:
+            dict: {'pico_id', 'name', 'batch_id', 'recipe_id'}, None if it is not mapped
+        """
+        return self._lookup('recipe_ids', recipe_id)
+
+    def by_name(self, name: str) -> dict:
+        """ I return the latest batch of a recipe by name
+
+        Args:
+            name (str): the recipe name
+
+        Returns:
+            dict: {'pico_id', 'name', 'batch_id', 'recipe_id'}, None if it is not mapped
+        """
+        return self._lookup('names', name)
+
+    def __contains__(self, batch_id: str) -> bool:
+        with self._lock:
+            return batch_id in self.batches or batch_id in self._pending
+
+    def add(self, batch_id: str, name: str, recipe_id: str) -> None:
+        """ I add a batch, its pico id is handed out by save. A batch
+            planned again after it was archived keeps its pico id.
+
+        Args:
+            batch_id (str): the brewfather batch id
+            name (str): the recipe name
+            recipe_id (str): the brewfather recipe id
+        """
+        if batch_id in self:
+            return
+        archived = self.archived('batches', batch_id)
+        with self._lock:
+            if batch_id in self:
+                return
+            self._pending[batch_id] = (
+                archived['pico_id'] if archived else None,
+                {
+                    'name': name,
+                    'batch_id': batch_id,
+                    'recipe_id': recipe_id,
+                }
+            )
+
+    def save(self) -> None:
+        """ I write the batches added since the last save, in one update.
+            The batches are taken from the queue before writing, those added
+            meanwhile are kept for the next save.
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            queued, self._pending = self._pending, {}
+        pending = list(queued.values())
+
+        def apply(current: str) -> str:
+            result = _convert(json.loads(current)) if current else _empty()
+            known = {entry['batch_id'] for entry in result['recipes'].values()}
+            for pico_id, entry in pending:
+                if entry['batch_id'] in known:
+                    continue
+                if pico_id is None:
+                    pico_id = result['next_id']
+                    result['next_id'] += 1
+                result['recipes'][str(pico_id)] = entry
+            return json.dumps(result)
+
+        LOG.debug('adding %s batches to %s', len(pending), self.key)
+        try:
+            self._index(json.loads(prosaic.s3_update(self.key, apply, '')))
+        except Exception:  # pylint: disable=broad-exception-caught
+            with self._lock:
+                self._pending = dict(queued, **self._pending)
+            raise
+        self.loaded = time.time()
+        with self._lock:
+            self._misses = {}
+
+    def compact(self, keep: set) -> int:
+        """ I move the batches which are not in keep to the archive
+
+        Args:
+            keep (set): the batch ids to keep in the map, the planned and
+                brewing batches
+
+        Returns:
+            int: how many batches were archived
+        """
+        with self._lock:
+            self.load(fresh=True)
+            archive = {
+                pico_id: entry
+                for pico_id, entry in self.data['recipes'].items()
+                if entry['batch_id'] not in keep
+            }
+            if not archive:
+                return 0
+
+            def add(current: str) -> str:
+                result = json.loads(current) if current else {'recipes': {}}
+                result['recipes'].update(archive)
+                return json.dumps(result)
+
+            def remove(current: str) -> str:
+                result = _convert(json.loads(current)) if current else _empty()
+                for pico_id in archive:
+                    result['recipes'].pop(pico_id, None)
+                return json.dumps(result)
+
+            # archive first, a batch in both is still found
+            prosaic.s3_update(self.archive_key, add, '')
+            self._index(json.loads(prosaic.s3_update(self.key, remove, '')))
+            self.loaded = time.time()
+            self._archive = (0, {})
+            self._misses = {}
+            LOG.info('archived %s batches of %s', len(archive), self.user_id)
+            return len(archive)
+
+
+_MAPS = {}
+
+_MAPS_LOCK = threading.Lock()
+
+
+def get_recipe_map(user_id: str) -> RecipeMap:
+    """ I return the recipe map of a user, shared within the process
+
+    Args:
+        user_id (str): the brewfather user_id
+
+    Returns:
+        RecipeMap: the recipe map of the user
+    """
+    with _MAPS_LOCK:
+        if user_id not in _MAPS:
+            _MAPS[user_id] = RecipeMap(user_id)
+            return _MAPS[user_id]
+        result = _MAPS[user_id]
+    if time.time() - result.loaded > CACHE_TIME:
+        result.load()
+    return result
+
+
+def compact_user(creds: object, force: bool=False) -> int:
+    """ I archive the batches of a user which are no longer planned or
+        brewing from the pico and planning maps, at most once per
+        COMPACT_INTERVAL unless forced.
+
+    Args:
+        creds (object): the authentication objects for brewfather
+        force (bool): compact even if it was done within COMPACT_INTERVAL
+
+    Returns:
+        int: how many entries were archived
+    """
+    guard = f'compacted-{creds.user_id}'
+    if not CACHE.add(guard, time.time(), expire=COMPACT_INTERVAL) and not force:
+        return 0
+    try:
+        keep = set()
+        for status in ACTIVE_STATUSES:
+            keep |= {
+                batch['_id']
+                for batch in brewfather.BrewfatherClient(creds.auth()).batches(status)
+            }
+        return get_recipe_map(creds.user_id).compact(keep) \
+            + brewfather.compact_planning_recipe_map(creds.user_id, keep)
+    except Exception:  # pylint: disable=broad-exception-caught
+        # try again on the next run
+        CACHE.delete(guard)
+        raise
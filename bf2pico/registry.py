@@ -0,0 +1,181 @@
+"""
+    I provide the registry of active and finished brew sessions for a user.
+
+    The membership is kept in memory and only written when a session makes a
+    real transition, new to active, active to finished or finished to closed.
+    The writes go through prosaic.s3_update so workers updating the same user
+    at the same time do not overwrite each other. Within a process the
+    registry is shared by the request threads, so it is changed under a lock.
+"""
+
+
+import json
+import threading
+import time
+
+
+from bf2pico import (
+    CACHE_TIME,
+    LOG,
+    prosaic,
+)
+
+
+class SessionRegistry:
+    """
+        I am the active and finished sessions of a brewfather user.
+
+        Args:
+            user_id (str): the brewfather user_id
+    """
+    def __init__(self, user_id: str) -> object:
+        self.user_id = user_id
+        self.active_key = f'active-sessions/{user_id}.json'
+        self.finished_key = f'finished-sessions/{user_id}.json'
+        self.active = []
+        self.finished = []
+        self.loaded = 0
+        self._pending = {}
+        self._lock = threading.RLock()
+        self.load()
+
+    @property
+    def dirty(self) -> bool:
+        """ True when there are transitions which are not saved
+        """
+        return bool(self._pending)
+
+    def load(self) -> None:
+        """ I read the registry from storage, the transitions which are not
+            saved yet, such as those requeued by a failed save, are kept and
+            applied on top
+        """
+        active = json.loads(prosaic.s3_get(self.active_key, '[]'))
+        finished = json.loads(prosaic.s3_get(self.finished_key, '[]'))
+        with self._lock:
+            self.active = _apply(active, self._pending.get(self.active_key, []))
+            self.finished = _apply(finished, self._pending.get(self.finished_key, []))
+            self.loaded = time.time()
+
+    def refresh(self, max_age: int=CACHE_TIME) -> None:
+        """ I reload the registry if it is older than max_age and not dirty
+
+        Args:
+            max_age (int): seconds the in memory registry is trusted
+        """
+        with self._lock:
+            if not self.dirty and time.time() - self.loaded > max_age:
+                self.load()
+
+    def _change(self, key: str, operation: str, index: str) -> None:
+        self._pending.setdefault(key, []).append((operation, index))
+
+    def activate(self, index: str) -> None:
+        """ I add a session to active unless it is already known
+
+        Args:
+            index (str): the session index, {user_id}-{session_id}
+        """
+        with self._lock:
+            if index in self.active or index in self.finished:
+                return
+            LOG.debug('registering %s as active', index)
+            self.active.append(index)
+            self._change(self.active_key, 'add', index)
+
+    def finish(self, index: str) -> None:
+        """ I move a session from active to finished
+
+        Args:
+            index (str): the session index, {user_id}-{session_id}
+        """
+        with self._lock:
+            if index in self.active:
+                self.active.remove(index)
+                self._change(self.active_key, 'remove', index)
+            if index not in self.finished:
+                LOG.debug('registering %s as finished', index)
+                self.finished.append(index)
+                self._change(self.finished_key, 'add', index)
+
+    def close(self, index: str) -> None:
+        """ I remove a session from finished once it has been closed out
+
+        Args:
+            index (str): the session index, {user_id}-{session_id}
+        """
+        with self._lock:
+            if index in self.finished:
+                self.finished.remove(index)
+                self._change(self.finished_key, 'remove', index)
+
+    def save(self) -> None:
+        """ I write the transitions since the last save, if there are any
+
+        Each transition is applied to the latest stored registry so changes
+        by other workers are kept. The transitions are taken from the queue
+        before writing, those queued meanwhile are kept for the next save.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for key in list(pending):
+            def apply(current: str, operations=pending[key]) -> str:
+                return json.dumps(_apply(json.loads(current or '[]'), operations))
+
+            try:
+                stored = json.loads(prosaic.s3_update(key, apply, '[]'))
+            except Exception:  # pylint: disable=broad-exception-caught
+                # requeue what was not written, ahead of what was queued since
+                with self._lock:
+                    for unsaved, operations in pending.items():
+                        self._pending[unsaved] = operations + self._pending.get(unsaved, [])
+                raise
+            del pending[key]
+            with self._lock:
+                # keep the transitions queued while writing in memory
+                result = _apply(stored, self._pending.get(key, []))
+                if key == self.active_key:
+                    self.active = result
+                else:
+                    self.finished = result
+
+
+def _apply(result: list, operations: list) -> list:
+    """ I apply queued transitions to a registry list
+
+    Args:
+        result (list): the session indexes, changed in place
+        operations (list): (operation, index) with operation add or remove
+
+    Returns:
+        list: result
+    """
+    for operation, index in operations:
+        if operation == 'add' and index not in result:
+            result.append(index)
+        elif operation == 'remove' and index in result:
+            result.remove(index)
+    return result
+
+
+_REGISTRIES = {}
+
+_REGISTRIES_LOCK = threading.Lock()
+
+
+def get_registry(user_id: str) -> SessionRegistry:
+    """ I return the registry of a user, shared within the process
+
+    Args:
+        user_id (str): the brewfather user_id
+
+    Returns:
+        SessionRegistry: the registry of the user
+    """
+    with _REGISTRIES_LOCK:
+        if user_id not in _REGISTRIES:
+            _REGISTRIES[user_id] = SessionRegistry(user_id)
+            return _REGISTRIES[user_id]
+        result = _REGISTRIES[user_id]
+    result.refresh()
+    return result
@@ -4,21 +4,31 @@
 
 from datetime import datetime
 import json
+import os
 import random
 import string
 import time
 
 
+import diskcache
+
+
 from bf2pico import (
-    BUCKET,
     CACHE,
+    EPHEMERAL_CACHE_TIME,
     LOG,
     PARAMETER_PREFIX,
-    WEBSITE,
+    SESSION_FLUSH_EVENTS,
+    SESSION_FLUSH_SECONDS,
+    SESSION_SEGMENT_SIZE,
+    get_website,
     brewfather,
     brewplot,
     pico,
     prosaic,
+    recipemap,
+    registry,
+    sessionlog,
 )
 
 
@@ -54,41 +64,50 @@ DEFAULT_SESSION_DATA = {
 }
 
 
-def close_brewing(user_id: str, session_id: str, session_data: dict) -> None:
+def close_brewing(user_id: str, session_id: str, session_data: dict,
+        local_graph: str=None) -> None:
     """ I create graphs and email the results closing out brewing.
 
     Args:
         user_id (str): The brewfather user_id
         session_id (str): The unique id for the brew session.
         session_data (dict): The data for the brew session
+        local_graph (str): the graph already rendered for the session, it is
+            rendered if not given
     """
     emails = prosaic.get_parameters(f'{PARAMETER_PREFIX}/emails/')
-    local_graph =  f'data/{session_id}.png'
-    brewplot.create_graph(session_data, local_graph)
-    LOG.info('Graph Created %s', local_graph)
+    if not local_graph:
+        local_graph = brewplot.graph_filename(session_id)
+        brewplot.create_graph(session_data, local_graph)
+        LOG.info('Graph Created %s', local_graph)
     year_month_day = time.strftime('%Y-%m-%d', time.localtime(int(time.time())))
-    graph_key = f'graphs/{user_id}/{year_month_day}/{session_id}.png'
-    response = prosaic.S3.upload_file(
-        local_graph,
-        BUCKET,
-        graph_key
-    )
-    LOG.debug(json.dumps(response, default=str))
-    pico_id = session_data['Pico_Id']
-    recipe = pico.get_list_recipes_map(user_id)['by_pico_id'][str(pico_id)]
-    graph_url = f'{WEBSITE}{graph_key}'
-    data_url = f"{WEBSITE}sessions/{user_id}/{session_data['ID']}.json"
-    if f'emailed/{session_id}' not in prosaic.s3_getobjects('emailed/'):
+    extension = os.path.splitext(local_graph)[1]
+    graph_key = f'graphs/{user_id}/{year_month_day}/{session_id}{extension}'
+    prosaic.s3_upload_file(local_graph, graph_key)
+    # rinse and clean programs, or a batch no longer mapped, have no recipe
+    recipe = recipemap.get_recipe_map(user_id).get(session_data.get('Pico_Id', 0)) or {}
+    links = ''
+    if recipe:
+        links = (
+            "The brewfather brewing is https://web.brewfather.app/tabs/"
+            f"batches/batch/{recipe['batch_id']}\n"
+            "The brewfather recipe is https://web.brewfather.app/tabs/"
+            f"recipes/recipe/{recipe['recipe_id']}\n"
+        )
+    website = get_website()
+    graph_url = f'{website}{graph_key}'
+    full_key = published_key(f"sessions/{user_id}/{session_data['ID']}.json")
+    data_url = f'{website}{full_key}'
+    # publish the assembled session beside the manifest, which stays in place
+    prosaic.s3_put(json.dumps(as_dict(session_data)), full_key)
+    if not prosaic.s3_exists(f'emailed/{session_id}'):
         LOG.debug('Sending Email')
         prosaic.email(
             emails[user_id],
             f"'{session_data.get('Name', 'unknown')}' brew complete!",
             (
                 f"'{session_data.get('Name', 'unknown')}' brew complete!\n"
-                "The brewfather brewing is https://web.brewfather.app/tabs/"
-                f"batches/batch/{recipe['batch_id']}\n"
-                "The brewfather recipe is https://web.brewfather.app/tabs/"
-                f"recipes/recipe/{recipe['recipe_id']}\n"
+                f"{links}"
                 f"The graph is located at {graph_url}.\n"
                 f"The session data file is located {data_url}."
             ),
@@ -97,6 +116,380 @@ def close_brewing(user_id: str, session_id: str, session_data: dict) -> None:
     prosaic.s3_put('', f'emailed/{session_id}')
 
 
+# the suffix of the assembled sessions published at close out
+PUBLISHED_SUFFIX = '.full.json'
+
+SEGMENT_EXTENSIONS = {
+    'columns': '.bin',
+    'json': '.json',
+}
+
+
+def published_key(key: str) -> str:
+    """ I return the key the assembled session, with its log inline, is
+        published to once the brew is closed out
+
+    Args:
+        key (str): the session object key, sessions/{user_id}/{session_id}.json
+
+    Returns:
+        str: the published key, sessions/{user_id}/{session_id}.full.json
+    """
+    return f"{key[:-len('.json')] if key.endswith('.json') else key}{PUBLISHED_SUFFIX}"
+
+
+def segments_prefix(key: str) -> str:
+    """ I return the prefix the log segments of a session are stored under
+
+    Args:
+        key (str): the session object key, sessions/{user_id}/{session_id}.json
+
+    Returns:
+        str: the segment prefix, session-segments/{user_id}/{session_id}/
+    """
+    name = key[len('sessions/'):] if key.startswith('sessions/') else key
+    if name.endswith('.json'):
+        name = name[:-len('.json')]
+    return f'session-segments/{name}/'
+
+
+class SessionLogs:
+    """
+        I am an append-only list of session log events stored as segments.
+
+        Every segment object holds up to `size` events, so appending an event
+        only rewrites the last segment rather than the whole session.  The
+        segments are fetched lazily the first time one of their events is read
+        and are held in memory as SessionLogColumns.
+
+        Args:
+            prefix (str): the key prefix of the segment objects
+            count (int): the number of events already stored
+            size (int): the number of events per segment
+            segment_format (str): how segments are stored, columns or json
+            fresh (bool): revalidate the segments with s3 when they are loaded
+    """
+    def __init__(self, prefix: str, count: int=0, size: int=SESSION_SEGMENT_SIZE,
+            segment_format: str='columns', fresh: bool=False) -> object:
+        self.prefix = prefix
+        self.count = count
+        self.size = size
+        self.segment_format = segment_format
+        self.fresh = fresh
+        self._segments = {}
+        self._dirty = set()
+
+    @classmethod
+    def from_list(cls, prefix: str, records: list, size: int=SESSION_SEGMENT_SIZE) -> object:
+        """ I build the segments from an inline list of events
+
+        Args:
+            prefix (str): the key prefix of the segment objects
+            records (list): the events of the session
+            size (int): the number of events per segment
+
+        Returns:
+            SessionLogs: with every segment marked to be written on save
+        """
+        result = cls(prefix, 0, size)
+        for record in records:
+            result.append(record)
+        return result
+
+    def _segment_key(self, segment: int) -> str:
+        extension = SEGMENT_EXTENSIONS[self.segment_format]
+        return f'{self.prefix}{segment:05d}{extension}'
+
+    def _segment(self, segment: int) -> sessionlog.SessionLogColumns:
+        if segment not in self._segments:
+            LOG.debug('loading segment %s of %s', segment, self.prefix)
+            key = self._segment_key(segment)
+            if self.segment_format == 'columns':
+                body = prosaic.s3_get_bytes(key, None, fresh=self.fresh)
+                self._segments[segment] = \
+                    sessionlog.SessionLogColumns.from_bytes(body) if body \
+                    else sessionlog.SessionLogColumns()
+            else:
+                self._segments[segment] = sessionlog.SessionLogColumns.from_list(
+                    json.loads(prosaic.s3_get(key, '[]', fresh=self.fresh))
+                )
+        return self._segments[segment]
+
+    def _segment_count(self) -> int:
+        return (self.count + self.size - 1) // self.size
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[item] for item in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('session log index out of range')
+        return self._segment(index // self.size)[index % self.size]
+
+    def __iter__(self):
+        for segment in range(self._segment_count()):
+            yield from self._segment(segment)
+
+    def column(self, name: str, default=None) -> list:
+        """ I return the values of a key for every event
+
+        Args:
+            name (str): the key of the log events
+            default: the value for events without the key
+
+        Returns:
+            list: the values, one per event
+        """
+        result = []
+        for segment in range(self._segment_count()):
+            result += self._segment(segment).column(name, default)
+        return result
+
+    def append(self, record: dict) -> None:
+        """ I append an event to the last segment
+
+        Args:
+            record (dict): the log event
+        """
+        segment = self.count // self.size
+        if not self.count % self.size:
+            self._segments[segment] = sessionlog.SessionLogColumns()
+        self._segment(segment).append(record)
+        self._dirty.add(segment)
+        self.count += 1
+
+    def manifest(self) -> dict:
+        """ I return the manifest stored in the session object
+
+        Returns:
+            dict: {'Prefix': prefix, 'Count': count, 'Size': size, 'Format': format}
+        """
+        return {
+            'Prefix': self.prefix,
+            'Count': self.count,
+            'Size': self.size,
+            'Format': self.segment_format,
+        }
+
+    def save(self) -> None:
+        """ I write the segments which have changed since the last save
+        """
+        for segment in sorted(self._dirty):
+            if self.segment_format == 'columns':
+                body = self._segments[segment].to_bytes()
+            else:
+                body = json.dumps(self._segments[segment].to_list())
+            prosaic.s3_put(body, self._segment_key(segment))
+        self._dirty.clear()
+
+
+def attach_logs(data: dict, key: str, fresh: bool=False) -> dict:
+    """ I replace the session manifest or inline logs with a SessionLogs
+
+    Args:
+        data (dict): the session document
+        key (str): the session object key
+        fresh (bool): revalidate the segments with s3 when they are loaded
+
+    Returns:
+        dict: the session data with SessionLogs being a SessionLogs object
+    """
+    manifest = data.pop('Segments', None)
+    if manifest:
+        data['SessionLogs'] = SessionLogs(
+            manifest['Prefix'],
+            manifest['Count'],
+            manifest['Size'],
+            manifest.get('Format', 'json'),
+            fresh=fresh
+        )
+    else:
+        data['SessionLogs'] = SessionLogs.from_list(
+            segments_prefix(key),
+            data.get('SessionLogs') or []
+        )
+    return data
+
+
+def load_session(key: str, default: dict=None, fresh: bool=False) -> dict:
+    """ I load a session, the log events are only fetched when read
+
+    Args:
+        key (str): the session object key
+        default (dict): what to return if the session does not exist
+        fresh (bool): revalidate the session and its segments with s3 rather
+            than trust the cached copies, which may predate the writes of
+            another worker
+
+    Returns:
+        dict: the session data
+    """
+    result = prosaic.s3_get(key, None, fresh=fresh)
+    if not result:
+        return default
+    return attach_logs(json.loads(result), key, fresh=fresh)
+
+
+def session_header(data: dict) -> dict:
+    """ I return the session document to store, with the segment manifest
+        in place of the log events.
+
+    Args:
+        data (dict): the session data
+
+    Returns:
+        dict: the session document
+    """
+    result = {
+        key: value for key, value in data.items() if key != 'SessionLogs'
+    }
+    result['Segments'] = data['SessionLogs'].manifest()
+    return result
+
+
+def as_dict(data: dict) -> dict:
+    """ I return the session data with the log events as a plain list
+
+    Args:
+        data (dict): the session data
+
+    Returns:
+        dict: the session data as the device and website expect
+    """
+    result = dict(data)
+    result['SessionLogs'] = list(data.get('SessionLogs', []))
+    return result
+
+
+def _seconds_remaining(record: dict) -> int:
+    """ I return the SecondsRemaining of a log event, missing being 0
+    """
+    return int(record.get('SecondsRemaining', 0) or 0)
+
+
+def buffer_log(index: str, device_id: str, record: dict) -> bool:
+    """ I add a log event to the write-behind buffer of a session
+
+    The buffer lives in the local disk cache so every worker on the host
+    shares it.
+
+    Args:
+        index (str): the session index, {user_id}-{session_id}
+        device_id (str): the zymatic token, used to flush stale buffers
+        record (dict): the log event
+
+    Returns:
+        bool: True when the buffer should be flushed now
+    """
+    now = int(time.time())
+    key = f'pending-{index}'
+    with CACHE.transact():
+        entry = CACHE.get(key, None) or {
+            'device_id': device_id,
+            'since': now,
+            'step': None,
+            'flush': False,
+            'records': [],
+        }
+        if not entry['records']:
+            entry['since'] = now
+        entry['records'].append(record)
+
+        step = record.get('StepName', None)
+        if entry['step'] is not None and step != entry['step']:
+            LOG.debug('flushing %s on step change to %s', index, step)
+            entry['flush'] = True
+        entry['step'] = step
+
+        if not _seconds_remaining(record) \
+                or len(entry['records']) >= SESSION_FLUSH_EVENTS \
+                or now - entry['since'] >= SESSION_FLUSH_SECONDS:
+            entry['flush'] = True
+
+        CACHE.set(key, entry, expire=EPHEMERAL_CACHE_TIME)
+        pending = CACHE.get('pending-sessions', [])
+        if index not in pending:
+            CACHE.set('pending-sessions', pending + [index], expire=EPHEMERAL_CACHE_TIME)
+    return entry['flush']
+
+
+def pending_logs(index: str) -> list:
+    """ I return the buffered log events of a session
+
+    Args:
+        index (str): the session index, {user_id}-{session_id}
+
+    Returns:
+        list: the log events not yet written to s3
+    """
+    entry = CACHE.get(f'pending-{index}', None)
+    if not entry:
+        return []
+    return entry['records']
+
+
+def pop_pending(index: str) -> list:
+    """ I empty the write-behind buffer of a session
+
+    Args:
+        index (str): the session index, {user_id}-{session_id}
+
+    Returns:
+        list: the log events which were buffered
+    """
+    key = f'pending-{index}'
+    with CACHE.transact():
+        entry = CACHE.get(key, None)
+        if not entry:
+            return []
+        result = entry['records']
+        entry['records'] = []
+        entry['flush'] = False
+        CACHE.set(key, entry, expire=EPHEMERAL_CACHE_TIME)
+        pending = CACHE.get('pending-sessions', [])
+        if index in pending:
+            pending.remove(index)
+            CACHE.set('pending-sessions', pending, expire=EPHEMERAL_CACHE_TIME)
+    return result
+
+
+def flush_pending(max_age: int=SESSION_FLUSH_SECONDS) -> None:
+    """ I flush the write-behind buffers which have not seen an event for
+        max_age seconds, such as when a zymatic is turned off mid brew.
+
+    Args:
+        max_age (int): seconds since the first buffered event
+    """
+    now = int(time.time())
+    for index in list(CACHE.get('pending-sessions', [])):
+        entry = CACHE.get(f'pending-{index}', None)
+        if not entry or not entry['records']:
+            continue
+        if now - entry['since'] < max_age:
+            continue
+        LOG.info('flushing stale buffer for %s', index)
+        _, session_id = index.rsplit('-', 1)
+        BrewLog(_id=session_id, device_id=entry['device_id']).save(force=True)
+
+
+def flush_stale() -> None:
+    """ I flush the stale write-behind buffers of this host from the write
+        path, at most once per SESSION_FLUSH_SECONDS across its workers, so
+        the buffers reach s3 without the events daemon.
+    """
+    if not CACHE.add('flush-stale', time.time(), expire=SESSION_FLUSH_SECONDS):
+        return
+    try:
+        flush_pending()
+    except Exception:  # pylint: disable=broad-exception-caught
+        # the events daemon or the next write tries again
+        LOG.exception('unable to flush the stale buffers')
+
+
 def _gid() -> str:
     """ I generate a 32 char random alphanumeric string
     """
@@ -155,14 +548,32 @@ def new_session_data(creds: object, session_data: dict) -> dict:
 def next_session_id(user_id: str) -> int:
     """ I determine the next session id for the brewfather user
 
+    The next id is kept in a counter object per user, the first time a
+    user is seen the counter starts from their existing sessions.
+
     Args:
         user_id (str): the brewfather user_id
 
     Returns:
         int: next session id to use
     """
-    current = prosaic.s3_getobjects(f'sessions/{user_id}/')
-    return  104185 + len(current)
+    def allocate(current: str) -> str:
+        if current:
+            counter = json.loads(current)
+        else:
+            existing = [
+                key
+                for key in prosaic.s3_getobjects(f'sessions/{user_id}/')
+                if not key.endswith(PUBLISHED_SUFFIX)
+            ]
+            counter = {'next': 104185 + len(existing)}
+        allocated.append(counter['next'])
+        counter['next'] += 1
+        return json.dumps(counter)
+
+    allocated = []
+    prosaic.s3_update(f'session-ids/{user_id}.json', allocate)
+    return allocated[-1]
 
 
 def next_log_event_id(sessions: list) -> int:
@@ -202,44 +613,73 @@ class BrewLog:
         self.index = f'{self.user_id}-{self._id}'
         self.cache_key = f'sessions/{self.user_id}/{self._id}.json'
 
-        self.data = prosaic.s3_get(self.cache_key, None)
+        self.data = load_session(self.cache_key)
         if not self.data:
             session_data = kwargs.copy()
             session_data['ID'] = str(self._id)
             LOG.debug(json.dumps(session_data, indent=2))
-            self.data = new_session_data(self.creds, session_data)
+            self.data = attach_logs(
+                new_session_data(self.creds, session_data),
+                self.cache_key
+            )
 
-        if isinstance(self.data, str):
-            self.data = json.loads(self.data)
+        # events buffered by any worker on this host but not yet written
+        for record in pending_logs(self.index):
+            self.data['SessionLogs'].append(record)
+        self._buffered = False
+        self._flush = False
 
-    def save(self) -> None:
-        """ I save the save the brew log session
+    def as_dict(self) -> dict:
+        """ I return the session data with the log events as a list
         """
-        prosaic.s3_put(json.dumps(self.data), self.cache_key)
+        return as_dict(self.data)
 
-        active_key = f'active-sessions/{self.creds.user_id}.json'
-        finished_key = f'finished-sessions/{self.creds.user_id}.json'
+    def flush(self) -> None:
+        """ I write the buffered log events and the session to s3
+        """
+        with diskcache.Lock(CACHE, f'flush-{self.index}', expire=60):
+            records = pop_pending(self.index)
+            # rebuild from s3 as another worker may have flushed since we loaded
+            stored = load_session(self.cache_key, fresh=True)
+            if stored:
+                self.data['SessionLogs'] = stored['SessionLogs']
+            else:
+                self.data['SessionLogs'] = SessionLogs(segments_prefix(self.cache_key))
+            for record in records:
+                self.data['SessionLogs'].append(record)
+
+            # segments first so the manifest never points at unwritten events
+            self.data['SessionLogs'].save()
+            prosaic.s3_put(json.dumps(session_header(self.data)), self.cache_key)
+        self._buffered = False
+        self._flush = False
+
+    def save(self, force: bool=False) -> None:
+        """ I save the save the brew log session
 
-        active_sessions = json.loads(prosaic.s3_get(active_key, '[]'))
-        finished_sessions = json.loads(prosaic.s3_get(finished_key, '[]'))
+        Log events are held in the write-behind buffer until it is due to be
+        flushed, see buffer_log.
 
-        if self.index not in active_sessions:
-            active_sessions.append(self.index)
+        Args:
+            force (bool): flush even if the buffer is not due
+        """
+        if not force:
+            flush_stale()
+        if self._buffered and not self._flush and not force:
+            LOG.debug('buffering log event for %s', self.index)
+            return
+        self.flush()
 
-        if 'SessionLogs' not in self.data:
-            self.data['SessionLogs'] = []
+        sessions = registry.get_registry(self.creds.user_id)
+        sessions.activate(self.index)
 
         if len(self.data['SessionLogs']):
             record = self.data['SessionLogs'][-1]
-            seconds_remaining = int(record.get('SecondsRemaining', 0))
-            if not seconds_remaining:
-                active_sessions.remove(self.index)
-                if self.index not in finished_sessions:
-                    finished_sessions.append(self.index)
-                pico.change_batch_state(self.creds, self._id, 'fermenting')
+            if not _seconds_remaining(record) and self.index not in sessions.finished:
+                sessions.finish(self.index)
+                pico.change_batch_state(self.creds, self.data['Pico_Id'], 'fermenting')
 
-        prosaic.s3_put(json.dumps(active_sessions), active_key)
-        prosaic.s3_put(json.dumps(finished_sessions), finished_key)
+        sessions.save()
 
     def add_logs(self, log_event) -> None:
         """ I add event logs to the session.
@@ -249,6 +689,8 @@ class BrewLog:
             log_event['epoch'] = int(time.time())
 
         self.data['SessionLogs'].append(log_event)
+        self._flush = buffer_log(self.index, self.creds.device_id, log_event)
+        self._buffered = True
 
         result = {
             'ID': event_id,
@@ -0,0 +1,337 @@
+"""
+    I provide a compact columnar container for session log events.
+
+    A session log event is a flat dict such as
+        {
+            'ThermoBlockTemp': 65.1,
+            'WortTemp': 64.8,
+            'StepName': 'Mash',
+            'SecondsRemaining': 3600,
+            'rssi': -61,
+            ...
+        }
+    Rather than keeping a dict per event, every key is stored once as a column
+    holding a typed array of the values, and text values are interned.
+"""
+
+
+import json
+import struct
+import sys
+
+
+from array import array
+
+
+MAGIC = b'BFSL'
+
+VERSION = 1
+
+# column kinds, the array kinds use the typecode of the array
+KIND_BOOL = 'b'
+KIND_INT = 'q'
+KIND_FLOAT = 'd'
+KIND_TEXT = 'I'
+KIND_OBJECT = 'o'
+
+ARRAY_KINDS = (KIND_BOOL, KIND_INT, KIND_FLOAT, KIND_TEXT)
+
+INT_MIN = -2 ** 63
+INT_MAX = 2 ** 63 - 1
+
+
+def _kind(value) -> str:
+    """ I return the column kind that can store a value
+
+    Args:
+        value: the value of a log event key
+
+    Returns:
+        str: the column kind
+    """
+    if isinstance(value, bool):
+        return KIND_BOOL
+    if isinstance(value, int):
+        if INT_MIN <= value <= INT_MAX:
+            return KIND_INT
+        return KIND_OBJECT
+    if isinstance(value, float):
+        return KIND_FLOAT
+    if isinstance(value, str):
+        return KIND_TEXT
+    return KIND_OBJECT
+
+
+class Column:  # pylint: disable=too-few-public-methods
+    """
+        I am a single key of the session log events.
+
+        Rows where the key was not present are in absent and rows where it was
+        None are in nulls, both store a placeholder in values.
+
+        Args:
+            kind (str): the column kind, one of the KIND_ values
+            count (int): the number of rows already in the container
+    """
+    def __init__(self, kind: str, count: int=0) -> object:
+        self.kind = kind
+        self.values = self._new_values(kind)
+        self.absent = set(range(count))
+        self.nulls = set()
+        for _ in range(count):
+            self.values.append(self._placeholder())
+
+    @staticmethod
+    def _new_values(kind: str):
+        if kind in ARRAY_KINDS:
+            return array(kind)
+        return []
+
+    def _placeholder(self):
+        if self.kind == KIND_OBJECT:
+            return None
+        if self.kind == KIND_FLOAT:
+            return 0.0
+        return 0
+
+
+class SessionLogColumns:
+    """
+        I store session log events column by column.
+
+        I behave like a read only list of dicts for the events, with append to
+        add events, and column to read the values of one key for all events.
+    """
+    def __init__(self) -> object:
+        self.count = 0
+        self.columns = {}
+        self.strings = []
+        self._string_ids = {}
+
+    @classmethod
+    def from_list(cls, records: list) -> object:
+        """ I build a container from a list of log events
+
+        Args:
+            records (list): list of log event dicts
+
+        Returns:
+            SessionLogColumns: the container
+        """
+        result = cls()
+        for record in records:
+            result.append(record)
+        return result
+
+    def _intern(self, value: str) -> int:
+        if value not in self._string_ids:
+            self._string_ids[value] = len(self.strings)
+            self.strings.append(value)
+        return self._string_ids[value]
+
+    def _promote(self, column: Column, kind: str) -> None:
+        """ I change the kind of a column so it can store another kind
+
+        A column with only placeholders takes the new kind, an int column
+        receiving a float becomes a float column and any other mix becomes an
+        object column.
+        """
+        if len(column.absent | column.nulls) == self.count:
+            column.kind = kind
+            column.values = Column._new_values(kind)  # pylint: disable=protected-access
+            for _ in range(self.count):
+                column.values.append(column._placeholder())  # pylint: disable=protected-access
+        elif column.kind == KIND_INT and kind == KIND_FLOAT:
+            column.values = array(KIND_FLOAT, (float(value) for value in column.values))
+            column.kind = KIND_FLOAT
+        else:
+            column.values = [
+                self._value(column, index) for index in range(self.count)
+            ]
+            column.kind = KIND_OBJECT
+
+    def _store(self, column: Column, value) -> None:
+        if value is None:
+            column.nulls.add(self.count)
+            column.values.append(column._placeholder())  # pylint: disable=protected-access
+            return
+        kind = _kind(value)
+        if kind == KIND_INT and column.kind == KIND_FLOAT:
+            kind = KIND_FLOAT
+        if kind != column.kind:
+            self._promote(column, kind)
+        if column.kind == KIND_TEXT:
+            column.values.append(self._intern(value))
+        elif column.kind == KIND_FLOAT:
+            column.values.append(float(value))
+        else:
+            column.values.append(value)
+
+    def append(self, record: dict) -> None:
+        """ I add a log event
+
+        Args:
+            record (dict): the log event
+        """
+        for name, value in record.items():
+            if name not in self.columns:
+                kind = KIND_OBJECT if value is None else _kind(value)
+                self.columns[name] = Column(kind, self.count)
+            self._store(self.columns[name], value)
+        for name, column in self.columns.items():
+            if name not in record:
+                column.absent.add(self.count)
+                column.values.append(column._placeholder())  # pylint: disable=protected-access
+        self.count += 1
+
+    def extend(self, records: list) -> None:
+        """ I add several log events
+
+        Args:
+            records (list): list of log event dicts
+        """
+        for record in records:
+            self.append(record)
+
+    def _value(self, column: Column, index: int):
+        if index in column.nulls:
+            return None
+        value = column.values[index]
+        if column.kind == KIND_TEXT:
+            return self.strings[value]
+        if column.kind == KIND_BOOL:
+            return bool(value)
+        return value
+
+    def record(self, index: int) -> dict:
+        """ I return a log event as a dict
+
+        Args:
+            index (int): the index of the event
+
+        Returns:
+            dict: the log event
+        """
+        return {
+            name: self._value(column, index)
+            for name, column in self.columns.items()
+            if index not in column.absent
+        }
+
+    def column(self, name: str, default=None) -> list:
+        """ I return the values of a key for every event
+
+        Args:
+            name (str): the key of the log events
+            default: the value for events without the key
+
+        Returns:
+            list: the values, one per event
+        """
+        column = self.columns.get(name, None)
+        if column is None:
+            return [default] * self.count
+        if column.kind in (KIND_INT, KIND_FLOAT) \
+                and not column.absent and not column.nulls:
+            return column.values.tolist()
+        return [
+            default if index in column.absent else self._value(column, index)
+            for index in range(self.count)
+        ]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.record(item) for item in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('session log index out of range')
+        return self.record(index)
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self.record(index)
+
+    def to_list(self) -> list:
+        """ I return the log events as a list of dicts
+        """
+        return list(self)
+
+    def to_bytes(self) -> bytes:
+        """ I serialize the container
+
+        The layout is MAGIC, a version byte, the length of a json header as an
+        unsigned 32 bit little endian int, the json header and then the
+        little endian bytes of every array column in header order.
+
+        Returns:
+            bytes: the serialized container
+        """
+        header = {
+            'count': self.count,
+            'strings': self.strings,
+            'columns': [],
+        }
+        arrays = []
+        for name, column in self.columns.items():
+            meta = {
+                'name': name,
+                'kind': column.kind,
+                'absent': sorted(column.absent),
+                'nulls': sorted(column.nulls),
+            }
+            if column.kind in ARRAY_KINDS:
+                values = array(column.kind, column.values)
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                arrays.append(values.tobytes())
+            else:
+                meta['values'] = column.values
+            header['columns'].append(meta)
+        encoded = json.dumps(header, separators=(',', ':')).encode('utf8')
+        return b''.join(
+            [MAGIC, bytes([VERSION]), struct.pack('<I', len(encoded)), encoded]
+            + arrays
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> object:
+        """ I load a container serialized by to_bytes
+
+        Args:
+            data (bytes): the serialized container
+
+        Returns:
+            SessionLogColumns: the container
+        """
+        if data[:len(MAGIC)] != MAGIC or data[len(MAGIC)] != VERSION:
+            raise ValueError('Not a session log container')
+        offset = len(MAGIC) + 1
+        (length,) = struct.unpack_from('<I', data, offset)
+        offset += 4
+        header = json.loads(data[offset:offset + length].decode('utf8'))
+        offset += length
+
+        result = cls()
+        result.count = header['count']
+        result.strings = header['strings']
+        result._string_ids = {  # pylint: disable=protected-access
+            value: index for index, value in enumerate(result.strings)
+        }
+        for meta in header['columns']:
+            column = Column(meta['kind'])
+            column.absent = set(meta['absent'])
+            column.nulls = set(meta['nulls'])
+            if meta['kind'] in ARRAY_KINDS:
+                size = array(meta['kind']).itemsize * result.count
+                column.values.frombytes(data[offset:offset + size])
+                if sys.byteorder == 'big':
+                    column.values.byteswap()
+                offset += size
+            else:
+                column.values = meta['values']
+            result.columns[meta['name']] = column
+        return result
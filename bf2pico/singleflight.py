@@ -0,0 +1,88 @@
+"""
+    I coalesce identical upstream calls so only one is in flight per key.
+
+    Within a process the first caller of a key runs the fetch and the other
+    callers wait for its result. Across the workers of a host the callers
+    of a key take turns through a cache lock, and after waiting they look
+    in the cache the fetch fills before calling upstream themselves, so
+    the workers which waited are served what the first one fetched.
+"""
+
+
+import copy
+import hashlib
+import os
+import threading
+
+
+from concurrent.futures import Future
+
+
+import diskcache
+
+
+from bf2pico import (
+    CACHE,
+    LOG,
+)
+
+
+# seconds before the lock of a fetch which never finished is broken
+SINGLEFLIGHT_EXPIRE = int(os.getenv('BF2PICO_SINGLEFLIGHT_EXPIRE', '30'))
+
+MISSING = object()
+
+_FLIGHTS = {}
+
+_FLIGHTS_LOCK = threading.Lock()
+
+
+def flight_key(*parts) -> str:
+    """ I return a flight key, hashed so credentials in the parts are not
+        written to the cache as lock names.
+
+    Returns:
+        str: the key
+    """
+    return hashlib.sha256(repr(parts).encode('utf8')).hexdigest()
+
+
+def do(key: str, lookup, fetch):
+    """ I return what is cached for a key, else the result of one fetch
+        shared by every caller of the key.
+
+    Args:
+        key (str): the flight key, see flight_key
+        lookup: returns the cached result or MISSING
+        fetch: calls upstream, caches and returns the result
+
+    Returns:
+        the result of lookup or fetch
+    """
+    result = lookup()
+    if result is not MISSING:
+        return result
+
+    with _FLIGHTS_LOCK:
+        flight = _FLIGHTS.get(key, None)
+        leader = flight is None
+        if leader:
+            flight = _FLIGHTS[key] = Future()
+
+    if not leader:
+        LOG.debug('waiting on the flight %s', key)
+        return copy.deepcopy(flight.result())
+
+    try:
+        with diskcache.Lock(CACHE, f'flight-{key}', expire=SINGLEFLIGHT_EXPIRE):
+            result = lookup()
+            if result is MISSING:
+                result = fetch()
+    except BaseException as err_msg:
+        flight.set_exception(err_msg)
+        raise
+    finally:
+        with _FLIGHTS_LOCK:
+            _FLIGHTS.pop(key, None)
+    flight.set_result(result)
+    return result
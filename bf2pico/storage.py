@@ -0,0 +1,464 @@
+"""
+    I provide the storage backends for the objects bf2pico persists.
+
+    The backend is chosen with the BF2PICO_STORAGE environment variable:
+        - s3: (default) the BUCKET s3 bucket
+        - local: a directory, BF2PICO_STORAGE_PATH
+        - sqlite: a sqlite database file, BF2PICO_STORAGE_PATH
+"""
+
+
+import abc
+import fcntl
+import hashlib
+import mimetypes
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+
+from contextlib import closing
+
+
+from bf2pico import (
+    LOG,
+    get_bucket,
+)
+
+
+STORAGE_TYPE = os.getenv('BF2PICO_STORAGE', 's3').lower()
+
+STORAGE_PATH = os.getenv('BF2PICO_STORAGE_PATH', '')
+
+
+class PreconditionFailed(Exception):
+    """ I am raised when a conditional put finds the object has changed.
+    """
+
+
+def etag(body: bytes) -> str:
+    """ I return the etag of a body, the quoted md5 like s3 uses
+
+    Args:
+        body (bytes): the body of an object
+
+    Returns:
+        str: the etag
+    """
+    try:
+        digest = hashlib.md5(body, usedforsecurity=False)
+    except TypeError:
+        # python 3.8 has no usedforsecurity
+        digest = hashlib.md5(body)  # nosec
+    return f'"{digest.hexdigest()}"'
+
+
+class Storage(abc.ABC):
+    """
+        I am the interface every storage backend provides, a backend
+        missing one of the abstract methods can not be created.
+
+        Keys are '/' separated paths such as sessions/{user_id}/{id}.json and
+        bodies are bytes.
+    """
+    @abc.abstractmethod
+    def describe(self, key: str) -> str:
+        """ I return a printable location of a key for logging
+
+        Args:
+            key (str): the object key
+
+        Returns:
+            str: the location of the object
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get(self, key: str) -> bytes:
+        """ I return the body of an object
+
+        Args:
+            key (str): the object key
+
+        Returns:
+            bytes: the body of the object or None if it does not exist
+        """
+        raise NotImplementedError
+
+    def get_versioned(self, key: str) -> tuple:
+        """ I return the body of an object with its etag
+
+        Args:
+            key (str): the object key
+
+        Returns:
+            tuple: (body, etag) or (None, None) if it does not exist
+        """
+        body = self.get(key)
+        if body is None:
+            return None, None
+        return body, etag(body)
+
+    def revalidate(self, key: str, known_etag: str) -> tuple:
+        """ I return the body of an object only if it no longer has an etag
+
+        Args:
+            key (str): the object key
+            known_etag (str): the etag of the copy the caller has
+
+        Returns:
+            tuple: (None, known_etag) if unchanged, (body, etag) if changed
+                or (None, None) if it no longer exists
+        """
+        body, current = self.get_versioned(key)
+        if current is not None and current == known_etag:
+            return None, known_etag
+        return body, current
+
+    @abc.abstractmethod
+    def put(self, key: str, body: bytes, *, content_type: str='',  # pylint: disable=too-many-arguments
+            content_encoding: str='', if_match: str='', if_none_match: bool=False) -> str:
+        """ I write an object
+
+        Args:
+            key (str): the object key
+            body (bytes): the body of the object
+            content_type (str): the mime type of the object
+            content_encoding (str): the encoding of the body, such as gzip
+            if_match (str): only write if the object still has this etag
+            if_none_match (bool): only write if the object does not exist
+
+        Returns:
+            str: the etag of the written object
+
+        Raises:
+            PreconditionFailed: when a condition does not hold
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def exists(self, key: str) -> bool:
+        """ I return if an object exists without fetching it
+
+        Args:
+            key (str): the object key
+
+        Returns:
+            bool: True if the object exists
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def list(self, prefix: str) -> list:
+        """ I return the keys under a prefix
+
+        Args:
+            prefix (str): the prefix to list
+
+        Returns:
+            list: list of keys
+        """
+        raise NotImplementedError
+
+    def upload_file(self, filename: str, key: str) -> None:
+        """ I write a local file as an object
+
+        Args:
+            filename (str): the local file to upload
+            key (str): the object key
+        """
+        with open(filename, 'rb') as handler:
+            self.put(key, handler.read())
+
+
+class S3Storage(Storage):
+    """
+        I store objects in a s3 bucket.
+
+        Args:
+            bucket (str): the bucket name, BUCKET if not given
+    """
+    def __init__(self, bucket: str=None) -> object:
+        import boto3  # pylint: disable=import-outside-toplevel
+        self.bucket = bucket or get_bucket()
+        self.client = boto3.client('s3')
+
+    def describe(self, key: str) -> str:
+        return f's3://{self.bucket}/{key}'
+
+    def get(self, key: str) -> bytes:
+        return self.get_versioned(key)[0]
+
+    def get_versioned(self, key: str) -> tuple:
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=key)
+            return obj['Body'].read(), obj['ETag']
+        except self.client.exceptions.ClientError as err_msg:
+            if err_msg.response['Error']['Code'] == 'NoSuchKey':
+                return None, None
+            raise
+
+    def revalidate(self, key: str, known_etag: str) -> tuple:
+        try:
+            obj = self.client.get_object(
+                Bucket=self.bucket,
+                Key=key,
+                IfNoneMatch=known_etag
+            )
+            return obj['Body'].read(), obj['ETag']
+        except self.client.exceptions.ClientError as err_msg:
+            code = err_msg.response['Error']['Code']
+            if code in ('304', 'NotModified'):
+                return None, known_etag
+            if code == 'NoSuchKey':
+                return None, None
+            raise
+
+    def put(self, key: str, body: bytes, *, content_type: str='',  # pylint: disable=too-many-arguments
+            content_encoding: str='', if_match: str='', if_none_match: bool=False) -> str:
+        extra = {}
+        if content_type:
+            extra['ContentType'] = content_type
+        if content_encoding:
+            extra['ContentEncoding'] = content_encoding
+        if if_match:
+            extra['IfMatch'] = if_match
+        if if_none_match:
+            extra['IfNoneMatch'] = '*'
+        try:
+            result = self.client.put_object(
+                Bucket=self.bucket,
+                Key=key,
+                Body=body,
+                ACL='bucket-owner-full-control',
+                **extra
+            )
+        except self.client.exceptions.ClientError as err_msg:
+            if err_msg.response['Error']['Code'] in \
+                    ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise PreconditionFailed(key) from err_msg
+            raise
+        LOG.debug('put_object %s', result.get('ETag', ''))
+        return result.get('ETag', etag(body))
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except self.client.exceptions.ClientError as err_msg:
+            if err_msg.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def list(self, prefix: str) -> list:
+        result = []
+        response = self.client.list_objects_v2(
+            Bucket=self.bucket,
+            Prefix=prefix,
+            FetchOwner=False,
+        )
+        for record in response.get('Contents', []):
+            result.append(record['Key'])
+        while response.get('NextContinuationToken', None):
+            response = self.client.list_objects_v2(
+                Bucket=self.bucket,
+                Prefix=prefix,
+                ContinuationToken=response['NextContinuationToken']
+            )
+            for record in response.get('Contents', []):
+                result.append(record['Key'])
+        return result
+
+    def upload_file(self, filename: str, key: str) -> None:
+        self.client.upload_file(
+            filename,
+            self.bucket,
+            key,
+            ExtraArgs={
+                'ContentType': mimetypes.guess_type(key)[0] or 'application/octet-stream',
+            }
+        )
+
+
+class LocalStorage(Storage):
+    """
+        I store objects as files in a local directory.
+
+        Args:
+            path (str): the directory to store the objects in
+    """
+    def __init__(self, path: str='') -> object:
+        self.path = os.path.abspath(
+            os.path.expanduser(path or '~/.bf2pico-storage')
+        )
+        os.makedirs(self.path, exist_ok=True)
+
+    def _filename(self, key: str) -> str:
+        filename = os.path.abspath(os.path.join(self.path, key))
+        if not filename.startswith(self.path + os.sep):
+            raise ValueError(f'Invalid key {key}')
+        return filename
+
+    def describe(self, key: str) -> str:
+        return f'file://{self._filename(key)}'
+
+    def get(self, key: str) -> bytes:
+        try:
+            with open(self._filename(key), 'rb') as handler:
+                return handler.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, body: bytes, *, content_type: str='',  # pylint: disable=too-many-arguments
+            content_encoding: str='', if_match: str='', if_none_match: bool=False) -> str:
+        filename = self._filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # write then rename so readers never see a partial object
+        handle, temp_name = tempfile.mkstemp(prefix='.', dir=os.path.dirname(filename))
+        with os.fdopen(handle, 'wb') as handler:
+            handler.write(body)
+        if not if_match and not if_none_match:
+            os.replace(temp_name, filename)
+            return etag(body)
+        with open(os.path.join(self.path, '.lock'), 'w', encoding='utf8') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            current = self.get_versioned(key)[1]
+            if (if_none_match and current is not None) \
+                    or (if_match and current != if_match):
+                os.remove(temp_name)
+                raise PreconditionFailed(key)
+            os.replace(temp_name, filename)
+        return etag(body)
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self._filename(key))
+
+    def list(self, prefix: str) -> list:
+        result = []
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                key = os.path.relpath(
+                    os.path.join(root, name),
+                    self.path
+                ).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    result.append(key)
+        return sorted(result)
+
+    def upload_file(self, filename: str, key: str) -> None:
+        target = self._filename(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(filename, target)
+
+
+class SQLiteStorage(Storage):
+    """
+        I store objects as rows in a sqlite database.
+
+        Args:
+            path (str): the sqlite database file
+    """
+    def __init__(self, path: str='') -> object:
+        self.path = os.path.abspath(
+            os.path.expanduser(path or '~/.bf2pico-storage.sqlite')
+        )
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with closing(self._connect()) as connection:
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS objects ('
+                    'key TEXT PRIMARY KEY, body BLOB, modified REAL)'
+                )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def describe(self, key: str) -> str:
+        return f'sqlite://{self.path}#{key}'
+
+    def get(self, key: str) -> bytes:
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                'SELECT body FROM objects WHERE key = ?',
+                (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return bytes(row[0])
+
+    def put(self, key: str, body: bytes, *, content_type: str='',  # pylint: disable=too-many-arguments
+            content_encoding: str='', if_match: str='', if_none_match: bool=False) -> str:
+        with closing(self._connect()) as connection:
+            connection.isolation_level = None
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                if if_match or if_none_match:
+                    row = connection.execute(
+                        'SELECT body FROM objects WHERE key = ?',
+                        (key,)
+                    ).fetchone()
+                    current = etag(bytes(row[0])) if row else None
+                    if (if_none_match and current is not None) \
+                            or (if_match and current != if_match):
+                        raise PreconditionFailed(key)
+                connection.execute(
+                    'INSERT OR REPLACE INTO objects (key, body, modified) '
+                    'VALUES (?, ?, ?)',
+                    (key, sqlite3.Binary(body), time.time())
+                )
+                connection.execute('COMMIT')
+            except:  # pylint: disable=bare-except
+                connection.execute('ROLLBACK')
+                raise
+        return etag(body)
+
+    def exists(self, key: str) -> bool:
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                'SELECT 1 FROM objects WHERE key = ?',
+                (key,)
+            ).fetchone()
+        return row is not None
+
+    def list(self, prefix: str) -> list:
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                'SELECT key FROM objects WHERE substr(key, 1, ?) = ? '
+                'ORDER BY key',
+                (len(prefix), prefix)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+
+BACKENDS = {
+    's3': S3Storage,
+    'local': LocalStorage,
+    'sqlite': SQLiteStorage,
+}
+
+
+_STORAGE = {}
+
+
+def get_storage() -> Storage:
+    """ I return the configured storage backend, creating it on first use
+        in each process so a forked worker does not share the s3 client.
+
+    Returns:
+        Storage: the storage backend
+    """
+    key = (os.getpid(), STORAGE_TYPE)
+    if key not in _STORAGE:
+        if STORAGE_TYPE not in BACKENDS:
+            raise ValueError(f'Unsupported BF2PICO_STORAGE {STORAGE_TYPE}')
+        LOG.debug('Using %s storage', STORAGE_TYPE)
+        _STORAGE.clear()
+        if STORAGE_TYPE == 's3':
+            _STORAGE[key] = S3Storage()
+        else:
+            _STORAGE[key] = BACKENDS[STORAGE_TYPE](STORAGE_PATH)
+    return _STORAGE[key]
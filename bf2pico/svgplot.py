@@ -0,0 +1,253 @@
+"""
+    I plot a brew as a svg, with only the standard library.
+
+    The same downsampled series as the png are drawn, a polyline per series
+    with the axes, grid, legend, title and time range, without importing
+    matplotlib.
+"""
+
+
+import math
+import time
+
+
+from xml.sax.saxutils import escape, quoteattr
+
+
+from bf2pico import (
+    LOG,
+    brewplot,
+    downsample,
+)
+
+
+WIDTH = 640
+
+HEIGHT = 480
+
+# the space around the plot area, left, top, right, bottom
+MARGINS = (64, 48, 16, 64)
+
+# the matplotlib base colors used by brewplot.SERIES
+COLORS = {
+    'b': '#0000ff',
+    'g': '#008000',
+    'r': '#ff0000',
+    'y': '#bfbf00',
+}
+
+
+def ticks(low: float, high: float, count: int=6) -> list:
+    """ I return evenly spaced round values covering a range
+
+    Args:
+        low (float): the lowest value
+        high (float): the highest value
+        count (int): about how many ticks to return
+
+    Returns:
+        list: the tick values
+    """
+    if high <= low:
+        low, high = low - 1, high + 1
+    raw = (high - low) / count
+    power = 10 ** math.floor(math.log10(raw))
+    step = next(
+        power * factor
+        for factor in (1, 2, 2.5, 5, 10)
+        if power * factor >= raw
+    )
+    start = math.floor(low / step) * step
+    stop = math.ceil(high / step) * step
+    return [start + step * index for index in range(round((stop - start) / step) + 1)]
+
+
+def _label(value: float) -> str:
+    return f'{value:g}'
+
+
+class _Frame:
+    """
+        I am the plot area of the graph, I place values on it.
+
+        Args:
+            x_ticks (list): the ticks of the x axis, the first and last are its range
+            y_ticks (list): the ticks of the y axis, the first and last are its range
+    """
+    def __init__(self, x_ticks: list, y_ticks: list) -> object:
+        self.x_ticks = x_ticks
+        self.y_ticks = y_ticks
+        self.left, self.top, right, bottom = MARGINS
+        self.width = WIDTH - self.left - right
+        self.height = HEIGHT - self.top - bottom
+
+    def x(self, value: float) -> float:
+        """ I return the horizontal position of a x value
+        """
+        low, high = self.x_ticks[0], self.x_ticks[-1]
+        return self.left + (value - low) / (high - low) * self.width
+
+    def y(self, value: float) -> float:
+        """ I return the vertical position of a y value
+        """
+        low, high = self.y_ticks[0], self.y_ticks[-1]
+        return self.top + (high - value) / (high - low) * self.height
+
+
+def _axes(frame: _Frame, title: str, time_range: str) -> list:
+    """ I return the title, grid, frame, tick labels and axis labels
+
+    Args:
+        frame (_Frame): the plot area
+        title (str): the graph title
+        time_range (str): the x axis label
+
+    Returns:
+        list: the svg elements
+    """
+    bottom = frame.top + frame.height
+    right = frame.left + frame.width
+    result = [
+        f'<text x="{WIDTH / 2:g}" y="{frame.top - 16}" font-size="20" text-anchor="middle">'
+        f'{escape(title)}</text>',
+        '<g stroke="#b0b0b0" stroke-width="0.8">',
+    ]
+    for value in frame.x_ticks:
+        x_pos = f'{frame.x(value):.1f}'
+        result.append(f'<line x1="{x_pos}" y1="{frame.top}" x2="{x_pos}" y2="{bottom}"/>')
+    for value in frame.y_ticks:
+        y_pos = f'{frame.y(value):.1f}'
+        result.append(f'<line x1="{frame.left}" y1="{y_pos}" x2="{right}" y2="{y_pos}"/>')
+    result.append('</g>')
+    result.append(
+        f'<rect x="{frame.left}" y="{frame.top}" width="{frame.width}" '
+        f'height="{frame.height}" fill="none" stroke="#000000"/>'
+    )
+    for value in frame.x_ticks:
+        result.append(
+            f'<text x="{frame.x(value):.1f}" y="{bottom + 14}" '
+            f'text-anchor="middle">{_label(value)}</text>'
+        )
+    for value in frame.y_ticks:
+        result.append(
+            f'<text x="{frame.left - 6}" y="{frame.y(value) + 4:.1f}" '
+            f'text-anchor="end">{_label(value)}</text>'
+        )
+    result.append(
+        f'<text x="{frame.left + frame.width / 2:g}" y="{HEIGHT - 16}" '
+        f'text-anchor="middle">{escape(time_range)}</text>'
+    )
+    result.append(
+        f'<text transform="translate(16 {frame.top + frame.height / 2:g}) rotate(-90)" '
+        'text-anchor="middle">Temperature(°F)</text>'
+    )
+    return result
+
+
+def _polylines(frame: _Frame, x_values: list, y_values: list, color: str) -> list:
+    """ I return the line of a series, broken where a value is missing
+
+    Args:
+        frame (_Frame): the plot area
+        x_values (list): the x of each point
+        y_values (list): the y of each point, None where it is missing
+        color (str): the matplotlib color of the series
+
+    Returns:
+        list: the svg elements
+    """
+    stroke = quoteattr(COLORS.get(color, color))
+    result = [f'<g fill="none" stroke={stroke} stroke-width="1.5">']
+    points = []
+    for x_value, y_value in zip(x_values, y_values):
+        if y_value is not None:
+            points.append(f'{frame.x(x_value):.1f},{frame.y(y_value):.1f}')
+            continue
+        # a missing value breaks the line
+        if points:
+            result.append(f'<polyline points="{" ".join(points)}"/>')
+        points = []
+    if points:
+        result.append(f'<polyline points="{" ".join(points)}"/>')
+    result.append('</g>')
+    return result
+
+
+def _legend(frame: _Frame) -> list:
+    """ I return the legend of the series
+
+    Args:
+        frame (_Frame): the plot area
+
+    Returns:
+        list: the svg elements
+    """
+    result = []
+    for row, (_, color, label) in enumerate(brewplot.SERIES):
+        y_pos = frame.top + 14 + row * 16
+        result.append(
+            f'<line x1="{frame.left + 8}" y1="{y_pos - 4}" x2="{frame.left + 28}" '
+            f'y2="{y_pos - 4}" stroke={quoteattr(COLORS.get(color, color))} stroke-width="1.5"/>'
+        )
+        result.append(f'<text x="{frame.left + 34}" y="{y_pos}">{escape(label)}</text>')
+    return result
+
+
+def render(data: dict) -> str:
+    """ I return the svg of a session graph
+
+    Args:
+        data: dict of the session data
+
+    Returns:
+        str: the svg document
+    """
+    logs = data.get('SessionLogs', [])
+    series = downsample.sample(logs, [key for key, _, _ in brewplot.SERIES])
+    lines = {
+        key: [
+            None if value is None else brewplot.celsius_to_fahrenheit(value)
+            for value in series[key]
+        ]
+        for key, _, _ in brewplot.SERIES
+    }
+    known = [value for values in lines.values() for value in values if value is not None]
+    frame = _Frame(
+        ticks(min(series['index'], default=0), max(series['index'], default=1)),
+        ticks(min(known, default=0), max(known, default=1))
+    )
+
+    result = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{WIDTH}" height="{HEIGHT}" '
+        f'viewBox="0 0 {WIDTH} {HEIGHT}" font-family="sans-serif" font-size="11">',
+        f'<rect width="{WIDTH}" height="{HEIGHT}" fill="#ffffff"/>',
+    ]
+    result += _axes(frame, str(data.get('Name', 'unknown')), brewplot.time_range(logs))
+    for key, color, _ in brewplot.SERIES:
+        result += _polylines(frame, series['index'], lines[key], color)
+    if logs:
+        result += _legend(frame)
+    result.append('</svg>')
+    return '\n'.join(result) + '\n'
+
+
+def create_graph(data: dict, filename: str) -> None:
+    """ I create the graph as a svg
+
+    Args:
+        data: dict of the session data
+        filename: the file to write the graph, printed if empty.
+    """
+    started = time.monotonic()
+    svg = render(data)
+    if filename:
+        with open(filename, 'w', encoding='utf8') as handler:
+            handler.write(svg)
+    else:
+        print(svg)
+    LOG.info(
+        'svg graph of %s events (%s bytes) rendered in %.3fs',
+        len(data.get('SessionLogs', [])),
+        len(svg.encode('utf8')),
+        time.monotonic() - started
+    )
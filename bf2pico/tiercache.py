@@ -0,0 +1,183 @@
+"""
+    I provide a two tier cache, a bounded in process LRU in front of the
+    shared diskcache.
+
+    The LRU holds values already decoded, such as the parsed json of a
+    parameter path, so a hot key costs neither a sqlite lookup nor a parse.
+    Every write and delete goes through both tiers; another process sees a
+    change once its LRU entry is older than the ttl. Reads which must see
+    the writes of the other workers, such as under a lock or before
+    skipping a write, use get_shared or bypass the cache.
+"""
+
+
+import pickle
+import threading
+import time
+
+
+from collections import OrderedDict
+
+
+_MISSING = object()
+
+
+def _sizeof(value) -> int:
+    """ I estimate the memory a value holds
+
+    Args:
+        value: the cached value
+
+    Returns:
+        int: the size in bytes
+    """
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return 1024
+
+
+class TieredCache:
+    """
+        I am a bounded LRU over a diskcache.Cache.
+
+        Args:
+            disk (diskcache.Cache): the shared cache
+            max_bytes (int): the most the LRU may hold
+            ttl (int): seconds a LRU entry is trusted
+    """
+    def __init__(self, disk, max_bytes: int=16 * 1024 * 1024, ttl: int=10) -> object:
+        self.disk = disk
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key: str, value) -> None:
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = (value, time.monotonic() + self.ttl, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, _, old_size) = self._entries.popitem(last=False)
+                self.size -= old_size
+
+    def _forget(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def get(self, key: str, default=None, decode=None):
+        """ I return a value, from the LRU if it is there and fresh
+
+        Args:
+            key (str): the cache key
+            default: what to return if the key is in neither tier
+            decode: called with the diskcache value, the result is what the
+                LRU holds and what is returned
+
+        Returns:
+            the cached value
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                if entry[1] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                self._forget(key)
+
+        value = self.disk.get(key, _MISSING)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        self.disk_hits += 1
+        if decode is not None:
+            value = decode(value)
+        self._remember(key, value)
+        return value
+
+    def get_shared(self, key: str, default=None):
+        """ I return the diskcache value, never the LRU, so a write by
+            another worker of this host is seen at once
+
+        Args:
+            key (str): the cache key
+            default: what to return if the key is not in the diskcache
+
+        Returns:
+            the diskcache value
+        """
+        return self.disk.get(key, default)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry[1] > time.monotonic():
+                return True
+        return key in self.disk
+
+    def set(self, key: str, value, expire: int=None, hot_value=_MISSING) -> None:
+        """ I write a value to both tiers
+
+        Args:
+            key (str): the cache key
+            value: the value for the diskcache
+            expire (int): seconds until the diskcache entry expires
+            hot_value: the decoded value for the LRU, value if not given
+        """
+        self.disk.set(key, value, expire=expire)
+        self._remember(key, value if hot_value is _MISSING else hot_value)
+
+    def pop(self, key: str, default=None):
+        """ I remove a key from both tiers
+
+        Args:
+            key (str): the cache key
+            default: what to return if the key was not in the diskcache
+
+        Returns:
+            the diskcache value
+        """
+        with self._lock:
+            self._forget(key)
+        return self.disk.pop(key, default)
+
+    def delete(self, key: str) -> None:
+        """ I remove a key from both tiers
+
+        Args:
+            key (str): the cache key
+        """
+        self.pop(key)
+
+    def clear_memory(self) -> None:
+        """ I empty the LRU, the diskcache is untouched
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        """ I return the hit and miss counters
+
+        Returns:
+            dict: counters and the current size of the LRU
+        """
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'bytes': self.size,
+        }
@@ -5,15 +5,15 @@
 
 
 import json
-import os
-import uuid
 
 from flask import Flask, request
 
 
 from bf2pico import (
     brewfather,
+    journal,
     pico,
+    prefetch,
     session,
 )
 
@@ -24,17 +24,12 @@ app = Flask(__name__)
 
 def _save(data: dict) -> None:
     """
-        I save the request and response.
+        I journal the request and response.
     """
-    filename = f'data/{str(uuid.uuid4())}.json'
-
-    if not os.path.exists('data'):
-        os.makedirs('data')
-
-    with open(filename, 'w', encoding='utf8') as handler:
-        handler.write(
-            json.dumps(data, indent=2)
-        )
+    journal.get_journal().record(
+        data,
+        healthy=data.get('code', 200) != 404
+    )
 
 
 def zstate():
@@ -64,20 +59,33 @@ def zstate():
     }
 
 
-@app.route('/Vendors/input.cshtml', methods=['PUT'])
-def run_put():
+def _load(body: bytes) -> dict:
     """
-       I am the put method
+        I return the json request body, or {} if there isn't one.
     """
-    params = dict(request.args)
-
     try:
-        data = json.loads(request.data.decode('utf-8'))
+        return json.loads(body.decode('utf-8'))
     except:  # pylint: disable=bare-except
-        data = {}
+        return {}
+
+
+def handle_put(params: dict, body: bytes) -> dict:
+    """
+       I handle a put to input.cshtml
+
+    Args:
+        params (dict): the query string parameters
+        body (bytes): the request body
+
+    Returns:
+        dict: the response
+    """
+    data = _load(body)
 
     if params.get('type', 'unknown') == 'ZState':
         result = zstate()
+        if params.get('token', ''):
+            prefetch.schedule(device_id=params['token'])
 
     elif params.get('type', 'unknown') == 'ZSession':
         result = zsession(params['token'], data)
@@ -95,6 +103,14 @@ def run_put():
     return result
 
 
+@app.route('/Vendors/input.cshtml', methods=['PUT'])
+def run_put():
+    """
+       I am the put method
+    """
+    return handle_put(dict(request.args), request.data)
+
+
 def list_recipes(token: str):
     """_summary_
 
@@ -106,6 +122,7 @@ def list_recipes(token: str):
     """
     creds = brewfather.BrewAuth(device_id=token)
     recipe_list = pico.list_recipes(creds)
+    prefetch.schedule(creds)
     return \
         {
             'Kind': 1,
@@ -140,7 +157,7 @@ def zsession(token: str, request_data: dict) -> dict:
     )
     local_session.save()
 
-    return local_session.data
+    return local_session.as_dict()
 
 
 def zsession_log(token: str, request_data: dict) -> dict:
@@ -163,19 +180,17 @@ def zsession_log(token: str, request_data: dict) -> dict:
     return result
 
 
-@app.route('/Vendors/input.cshtml', methods=['POST'])
-def run_post():
-    """ I run the post for input.cshtml
+def handle_post(params: dict, body: bytes) -> dict:
+    """ I handle a post to input.cshtml
+
+    Args:
+        params (dict): the query string parameters
+        body (bytes): the request body
 
     Returns:
-        response from post
+        dict: the response
     """
-    params = dict(request.args)
-
-    try:
-        data = json.loads(request.data.decode('utf-8'))
-    except:  # pylint: disable=bare-except
-        data = {}
+    data = _load(body)
 
     if params.get('ctl', 'unknown') == 'RecipeRefListController':
         result = list_recipes(params['token'])
@@ -200,6 +215,16 @@ def run_post():
     return result
 
 
+@app.route('/Vendors/input.cshtml', methods=['POST'])
+def run_post():
+    """ I run the post for input.cshtml
+
+    Returns:
+        response from post
+    """
+    return handle_post(dict(request.args), request.data)
+
+
 def get_recipe(token:str, _id:int):
     """_summary_
 
@@ -214,18 +239,17 @@ def get_recipe(token:str, _id:int):
     return pico.get_recipe(creds, _id)
 
 
-@app.route('/Vendors/input.cshtml', methods=['GET'])
-def run_get():
-    """ I run the post for input.cshtml
+def handle_get(params: dict, body: bytes) -> dict:
+    """ I handle a get to input.cshtml
+
+    Args:
+        params (dict): the query string parameters
+        body (bytes): the request body
 
     Returns:
-        response from post
+        dict: the response
     """
-    params = dict(request.args)
-    try:
-        data = json.loads(request.data.decode('utf-8'))
-    except:  # pylint: disable=bare-except
-        data = {}
+    data = _load(body)
 
     if params.get('type', 'unknown') == 'Recipe':
         return get_recipe(params['token'], int(params['id']))
@@ -242,6 +266,16 @@ def run_get():
     return result
 
 
+@app.route('/Vendors/input.cshtml', methods=['GET'])
+def run_get():
+    """ I run the post for input.cshtml
+
+    Returns:
+        response from post
+    """
+    return handle_get(dict(request.args), request.data)
+
+
 @app.route('/health', methods=['GET'])
 def health():
     """ health """
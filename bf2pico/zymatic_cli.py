@@ -9,16 +9,15 @@ import sys
 import textwrap
 
 
-from tabulate import tabulate
-
-
 from bf2pico import (
     CACHE,
     LOG,
     brewfather,
     pico,
+    prefetch,
     get_parameter,
     prosaic,
+    recipemap,
 )
 
 
@@ -32,7 +31,7 @@ def _options() -> object:
     parser.add_argument('action',
         nargs=1,
         help='What to do',
-        choices=['add', 'update', 'delete', 'list', 'get'],
+        choices=['add', 'update', 'delete', 'list', 'get', 'compact'],
     )
     parser.add_argument('resource',
         nargs=1,
@@ -40,7 +39,7 @@ def _options() -> object:
         choices=[
             'device', 'devices', 'user', 'users', 'cache', 'email', 'emails',
             'recipes', 'recipe', 'mailserver', 'mailport', 'mailfrom',
-            'emaillogin', 'emailpassword'
+            'emaillogin', 'emailpassword', 'prefetch'
         ],
     )
     parser.add_argument('--keys',
@@ -259,6 +258,7 @@ def list_cache(_, args) -> None:
         _ (object): A object of the configured data
         args (object): argparse object
     """
+    from tabulate import tabulate  # pylint: disable=import-outside-toplevel
     if args.only_keys:
         result = []
         for key in CACHE:
@@ -312,6 +312,32 @@ def get_recipe(_, args) -> None:
     LOG.info(json.dumps(recipe, indent=2))
 
 
+def list_prefetch(_, __) -> None:
+    """ list the prefetch counters
+
+    Args:
+        _ (object): A object of the configured data
+        __ (object): argparse object
+    """
+    stats = {key: str(value) for key, value in prefetch.stats().items()}
+    LOG.info(display(stats, ['Counter', 'Value']))
+
+
+def compact_recipe(crowd, _) -> None:
+    """ I archive the batches no longer planned or brewing from the recipe
+        maps of every user
+
+    Args:
+        crowd (object): A object of the configured data
+        _ (object): argparse object
+    """
+    result = {}
+    for user_id in crowd.users:
+        creds = brewfather.BrewAuth(user_id=user_id)
+        result[user_id] = str(recipemap.compact_user(creds, force=True))
+    LOG.info(display(result, ['User', 'Archived']))
+
+
 def display(data, header: list) -> None:
     """_summary_
 
@@ -319,6 +345,7 @@ def display(data, header: list) -> None:
         data (dict, list): data to disply
         header (list): column headers
     """
+    from tabulate import tabulate  # pylint: disable=import-outside-toplevel
     result = []
     for key, value in data.items():
         result.append(
@@ -0,0 +1,101 @@
+"""
+    I check the entry points import in milliseconds.
+
+    Each module is imported in a fresh interpreter, with no BUCKET or
+    WEBSITE so a parameter lookup would show, and fails the check when its
+    best import time is over BF2PICO_IMPORT_BUDGET_MS or it loads a module
+    which must wait for first use, such as boto3 or matplotlib.
+"""
+
+
+import json
+import os
+import subprocess
+import sys
+
+
+# the most milliseconds an entry point may take to import
+IMPORT_BUDGET_MS = int(os.getenv('BF2PICO_IMPORT_BUDGET_MS', '300'))
+
+# how many times each module is imported, the best time is kept
+RUNS = 3
+
+# the console scripts and the gunicorn app
+ENTRY_POINTS = [
+    'bf2pico.brewplot',
+    'bf2pico.events',
+    'bf2pico.recipe',
+    'bf2pico.webapp',
+    'bf2pico.zymatic_cli',
+]
+
+# imported on first use, never by an import
+DEFERRED = [
+    'boto3',
+    'botocore',
+    'matplotlib',
+    'numpy',
+    'requests',
+    'tabulate',
+]
+
+PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+import {module}
+print(json.dumps({{
+    'ms': (time.perf_counter() - started) * 1000,
+    'loaded': [name for name in {deferred!r} if name in sys.modules],
+}}))
+'''
+
+
+def measure(module: str) -> dict:
+    """ I import a module in a fresh interpreter
+
+    Args:
+        module (str): the module to import
+
+    Returns:
+        dict: 'ms' the import time, 'loaded' the deferred modules it loaded
+            and 'error' the last line of the error if the import failed
+    """
+    env = {
+        key: value
+        for key, value in os.environ.items()
+        if key not in ('BUCKET', 'WEBSITE')
+    }
+    process = subprocess.run(
+        [sys.executable, '-c', PROBE.format(module=module, deferred=DEFERRED)],
+        capture_output=True,
+        check=False,
+        env=env,
+        text=True,
+    )
+    if process.returncode:
+        return {
+            'ms': float('inf'),
+            'loaded': [],
+            'error': (process.stderr.strip().splitlines() or ['failed'])[-1],
+        }
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def main() -> int:
+    """ main method
+    """
+    failed = False
+    for module in ENTRY_POINTS:
+        results = [measure(module) for _ in range(RUNS)]
+        best = min(result['ms'] for result in results)
+        loaded = results[0]['loaded'] + [results[0].get('error', '')]
+        status = 'ok'
+        if best > IMPORT_BUDGET_MS or any(loaded):
+            status = 'FAIL'
+            failed = True
+        print(f'{status:4} {module:20} {best:7.1f} ms {" ".join(loaded).strip()}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,3 +2,6 @@
 source ~/common/bin/activate
 
 validate .
+
+# the entry points must import in milliseconds, without network calls
+python "$(dirname "$0")/import_budget.py"